@@ -0,0 +1,408 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+import numpy as np
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from VocabStore import VocabStore
+from ModelRegistry import ModelRegistry
+
+# a small tagged lexicon the synthetic sentences are drawn from
+LEXICON = {
+    "NOUN": ["місто", "книга", "вчитель", "річка", "дерево", "вікно", "країна", "робота", "людина", "держава",
+             "мова", "школа", "дорога", "весна", "поле", "історія", "пісня", "родина", "слово", "земля"],
+    "VERB": ["читає", "пише", "бачить", "знає", "працює", "говорить", "живе", "любить", "будує", "шукає",
+             "відкриває", "співає", "думає", "приходить"],
+    "ADJ": ["великий", "новий", "зелена", "українська", "старе", "добрий", "тиха", "високе", "рідна", "світлий"],
+    "PRON": ["він", "вона", "ми", "вони", "це", "той"],
+    "NUM": ["два", "три", "п'ять", "десять"],
+    "ADV": ["швидко", "тепер", "завжди", "дуже", "тут", "вчора"],
+    "CCONJ": ["і", "та", "але", "або"],
+    "ADP": ["від", "для", "по", "через", "про", "над", "під", "до", "з", "на", "за", "в", "між", "біля"],
+}
+POS_WEIGHTS = {"NOUN": 30, "VERB": 18, "ADJ": 14, "PRON": 6, "NUM": 3, "ADV": 8, "CCONJ": 7, "ADP": 14}
+
+# the run of the benchmark in a worker process
+def _run_benchmark_case(benchmark, name):
+    return benchmark.run_case(name)
+
+class StandInToken(object):
+    def __init__(self, text, pos):
+        self.text = text
+        self.pos_ = pos
+
+class StandInParser(object):
+    """
+    Stand-in for the UDPipe model: splits off the punctuation and tags the words from the lexicon.
+    """
+    def __init__(self):
+        self.tags = {word: pos for pos, words in LEXICON.items() for word in words}
+        self.word_re = re.compile(r"[\w'’ʼ-]+|[^\w\s]")
+
+    def __call__(self, text):
+        return [StandInToken(word, self.tags.get(word.lower(), "NOUN" if word[0].isalnum() else "PUNCT"))
+                for word in self.word_re.findall(text)]
+
+    def pipe(self, texts, batch_size=None, n_process=None):
+        for text in texts:
+            yield self(text)
+
+class StandInInflector(object):
+    """
+    Stand-in for the pymorphy2-based Inflector: a fixed set of cases and suffix-based descriptions.
+    """
+    cases = {"nomn": "sing nomn", "gent": "sing gent", "datv": "sing datv", "accs": "sing accs", "ablt": "sing ablt", "loct": "sing loct"}
+
+    def __init__(self, morph=None):
+        self.d_straight = {pos: {vidm: vidm for vidm in self.cases} for pos in ("NOUN", "VERB", "NPRO", "ADJF", "NUMR")}
+        self.d_reverse = {pos: {description: vidm for vidm, description in self.cases.items()} for pos in self.d_straight}
+        self.vidms = list(self.cases)
+
+    def describe_word(self, pos, word):
+        if len(word) < 2:
+            raise ValueError(f"Cannot describe {word}")
+        return {"sing", self.vidms[len(word) % len(self.vidms)]}
+
+    def inflect_word(self, word, vidm, pos):
+        return word[:-1] + {"nomn": "а", "gent": "и", "datv": "і", "accs": "у", "ablt": "ою", "loct": "і"}[vidm]
+
+class StandInTranslator(object):
+    """
+    Stand-in for the uk-ru translation pipeline: russifies the vowels of every word.
+    """
+    def __call__(self, words, batch_size=None):
+        return [{"translation_text": word.replace("і", "и").replace("є", "е")} for word in words]
+
+class StandInModule(object):
+    # a module-like namespace holding the stand-in loaders
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+@contextmanager
+def patched(module, **replacements):
+    # temporarily swapping module globals for their stand-ins
+    originals = {name: getattr(module, name) for name in replacements}
+    for name, value in replacements.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(module, name, value)
+
+class Benchmark(object):
+    """
+    Benchmarks the hot paths of the errorifiers on reproducible synthetic Ukrainian corpora.
+    Every case runs in its own process, so its peak RSS is not inflated by the other cases, and is timed
+    as the best of several repeats. The results are written as JSON and can be compared between versions.
+
+    models="auto" loads the real models and falls back to the stand-ins when they cannot be loaded offline;
+    models="stand-in" always uses the stand-ins, which keeps the numbers comparable between machines.
+    """
+    cases = {
+        "punct.tokenize_sentence": "bench_tokenize_sentence",
+        "punct.errorify_and_tag": "bench_errorify_and_tag",
+        "punct.anti_tagger": "bench_anti_tagger",
+        "inversion.switch_words": "bench_switch_words",
+        "inversion.invert_chunk": "bench_invert_chunk",
+        "russism.antichanger": "bench_antichanger",
+        "russism.find_surzhik_candidates": "bench_find_surzhik_candidates",
+        "grammar.errorify_lines": "bench_grammar",
+    }
+
+    def __init__(self, n_sentences=10000, sentence_length=12, seed=42, repeats=3, max_words=300, models="auto", isolate=True):
+        if models not in ("auto", "stand-in"):
+            raise ValueError(f"Unknown models {models}, expected 'auto' or 'stand-in'")
+        self.n_sentences = n_sentences
+        self.sentence_length = sentence_length # mean number of words in a sentence
+        self.seed = seed
+        self.repeats = repeats
+        self.max_words = max_words # number of distinct words for the word-level russism cases
+        self.models = models
+        self.isolate = isolate # one process per case
+
+    def synthetic_corpus(self, n_sentences=None, sentence_length=None, seed=None):
+        """ A list of Ukrainian-looking sentences, the same for the same arguments """
+        n_sentences = self.n_sentences if n_sentences is None else n_sentences
+        sentence_length = self.sentence_length if sentence_length is None else sentence_length
+        rng = random.Random(self.seed if seed is None else seed)
+        tags = list(POS_WEIGHTS)
+        weights = [POS_WEIGHTS[pos] for pos in tags]
+
+        corpus = []
+        for i in range(n_sentences):
+            n_words = max(2, int(round(rng.gauss(sentence_length, sentence_length / 4))))
+            words = []
+            for pos in rng.choices(tags, weights, k=n_words):
+                word = rng.choice(LEXICON[pos])
+                # the punctuation inside the sentence
+                x = rng.random()
+                if x < 0.08:
+                    word += ","
+                elif x < 0.09:
+                    word += ":"
+                elif x < 0.1 and words:
+                    word = chr(8212) + " " + word
+                words.append(word)
+            words[0] = words[0][0].upper() + words[0][1:]
+            if rng.random() < 0.05: # a quotation
+                words[0] = '"' + words[0]
+                words[-1] = words[-1].rstrip(",:") + '"'
+            ending = rng.choices([".", "?", "!", "..."], [85, 7, 5, 3])[0]
+            corpus.append(" ".join(words).rstrip(",:") + ending)
+        return corpus
+
+    def write_corpus(self, path, n_sentences=None, sentence_length=None, seed=None):
+        # the corpus as an input file of the errorifiers
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.synthetic_corpus(n_sentences, sentence_length, seed)))
+
+    def peak_rss_mb(self):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+    def count_tokens(self, sentences):
+        return sum(len(sentence.split()) for sentence in sentences)
+
+    # the cases: each one sets up its errorifier and returns what to time
+    def bench_tokenize_sentence(self, corpus):
+        from PunctErrorifier import PunctErrorifier
+        errorifier = PunctErrorifier()
+        sentences = [errorifier.space_handler.fried_nails(sentence) for sentence in corpus]
+        def run():
+            for sentence in sentences:
+                errorifier.tokenize_sentence(sentence)
+        return {"run": run, "items": len(sentences), "tokens": self.count_tokens(sentences), "unit": "sentence"}
+
+    def bench_errorify_and_tag(self, corpus):
+        from PunctErrorifier import PunctErrorifier
+        errorifier = PunctErrorifier()
+        errorifier.generate_transfer_matrix()
+        sentences = [errorifier.space_handler.fried_nails(sentence) for sentence in corpus]
+        def run():
+            rng = np.random.default_rng(self.seed)
+            for sentence in sentences:
+                errorifier.errorify_and_tag(sentence, rng)
+        return {"run": run, "items": len(sentences), "tokens": self.count_tokens(sentences), "unit": "sentence"}
+
+    def bench_anti_tagger(self, corpus):
+        from PunctErrorifier import PunctErrorifier
+        errorifier = PunctErrorifier()
+        errorifier.generate_transfer_matrix()
+        sentences = [errorifier.space_handler.fried_nails(sentence) for sentence in corpus]
+        rng = np.random.default_rng(self.seed)
+        tagged = [errorifier.new_errorifier_tagger(sentence, rng) for sentence in sentences]
+        mismatches = sum(errorifier.anti_tagger(tokens, labels) != sentence for sentence, (tokens, labels) in zip(sentences, tagged))
+        def run():
+            for tokens, labels in tagged:
+                errorifier.anti_tagger(tokens, labels)
+        return {"run": run, "items": len(tagged), "tokens": self.count_tokens(sentences), "unit": "sentence",
+                "counters": {"mismatches": mismatches}}
+
+    def bench_switch_words(self, corpus):
+        from InversionErrorifier import InversionErrorifier
+        errorifier = InversionErrorifier()
+        def run():
+            random.seed(self.seed)
+            for sentence in corpus:
+                errorifier.switch_words(sentence)
+        return {"run": run, "items": len(corpus), "tokens": self.count_tokens(corpus), "unit": "sentence"}
+
+    def bench_invert_chunk(self, corpus):
+        from InversionErrorifier import InversionErrorifier
+        errorifier = InversionErrorifier(seed=self.seed)
+        def run():
+            for chunk_id, chunk in enumerate(errorifier.stream_handler.chunked(corpus, errorifier.chunk_size)):
+                errorifier.invert_chunk(chunk, chunk_id)
+        return {"run": run, "items": len(corpus), "tokens": self.count_tokens(corpus), "unit": "sentence"}
+
+    def russism_errorifier(self, words):
+        import RussismErrorifier
+        # the vocabulary: the words and their russified spellings, only the words themselves being correct
+        folder = tempfile.mkdtemp(prefix="russism-bench-")
+        misspelled = {word.replace("і", "и").replace("о", "а") for word in words} - set(words)
+        with open(folder + "/wordlist.txt", 'w') as f:
+            f.write('\n'.join(words))
+        with open(folder + "/frequency-vocab.txt", 'w') as f:
+            f.write('\n'.join(f"{word} {len(word)}" for word in sorted(set(words) | misspelled)))
+        VocabStore.build(folder + "/wordlist.txt", folder + "/frequency-vocab.txt", folder + "/vocab-store")
+        # the translator is not timed by the word-level cases, so it is always the stand-in
+        with patched(RussismErrorifier, pipeline=lambda **kwargs: StandInTranslator()):
+            errorifier = RussismErrorifier.RussismErrofifier(cache_path=folder + "/cache.sqlite", vocab_folder=folder + "/vocab-store",
+                                                             models=ModelRegistry()) # the stand-in is not shared
+            errorifier.models.load()
+        return errorifier, folder
+
+    def distinct_words(self, corpus):
+        words = []
+        for sentence in corpus:
+            words.extend(re.findall(r"[^\W\d_]+", sentence.lower()))
+        return list(dict.fromkeys(words))[:self.max_words]
+
+    def bench_antichanger(self, corpus):
+        words = self.distinct_words(corpus)
+        errorifier, folder = self.russism_errorifier(words)
+        def run():
+            for word in words:
+                errorifier.antichanger(word)
+        return {"run": run, "items": len(words), "tokens": len(words), "unit": "word", "models": "stand-in", "cleanup": folder}
+
+    def bench_find_surzhik_candidates(self, corpus):
+        words = self.distinct_words(corpus)
+        errorifier, folder = self.russism_errorifier(words)
+        russian = [word.replace("і", "и").replace("є", "е") for word in words]
+        def run():
+            for word in russian:
+                errorifier.find_surzhik_candidates(word) # uncached
+        return {"run": run, "items": len(russian), "tokens": len(russian), "unit": "word", "models": "stand-in", "cleanup": folder}
+
+    def grammar_errorifier(self):
+        import GrammarErrofifier
+        if self.models == "auto":
+            try:
+                # the models are loaded lazily, so they are loaded here to know if they are there
+                errorifier = GrammarErrofifier.GrammarErrofifier()
+                errorifier.models.load()
+                return errorifier, "real"
+            except Exception as e:
+                print(f"Could not load the grammar models ({e}), using the stand-ins")
+        stand_ins = {
+            "spacy_udpipe": StandInModule(load_from_path=lambda **kwargs: StandInParser()),
+            "pymorphy2": StandInModule(MorphAnalyzer=lambda **kwargs: None),
+            "Inflector": StandInInflector,
+        }
+        with patched(GrammarErrofifier, **stand_ins):
+            errorifier = GrammarErrofifier.GrammarErrofifier(models=ModelRegistry()) # the stand-ins are not shared
+            errorifier.models.load()
+            return errorifier, "stand-in"
+
+    def bench_grammar(self, corpus):
+        errorifier, models = self.grammar_errorifier()
+        counters = {}
+        def run():
+            # every repeat starts cold, like a fresh run
+            random.seed(self.seed)
+            errorifier.vidm_cache.cache_clear()
+            errorifier.inflection_cache.cache_clear()
+            counters["dropped"] = sum(errorified is None for sentence, errorified in errorifier.errorify_lines(corpus))
+            counters.update({name + "_hit_rate": stats["hit_rate"] for name, stats in errorifier.cache_stats().items()})
+        return {"run": run, "items": len(corpus), "tokens": self.count_tokens(corpus), "unit": "sentence",
+                "models": models, "counters": counters}
+
+    def run_case(self, name):
+        """ Sets the case up, times it and reports the throughput, the latency per token and the peak RSS """
+        if name not in self.cases:
+            raise ValueError(f"Unknown case {name}, expected one of {list(self.cases)}")
+        corpus = self.synthetic_corpus()
+        try:
+            case = getattr(self, self.cases[name])(corpus)
+        except ImportError as e: # the dependencies of the errorifier are missing
+            return {"skipped": str(e)}
+
+        try:
+            rss_before = self.peak_rss_mb()
+            times = []
+            for i in range(self.repeats):
+                t0 = time.perf_counter()
+                case["run"]()
+                times.append(time.perf_counter() - t0)
+            best = min(times)
+            result = {
+                "unit": case["unit"],
+                "items": case["items"],
+                "tokens": case["tokens"],
+                "models": case.get("models", "none"),
+                "seconds": best,
+                "seconds_per_repeat": times,
+                "items_per_sec": case["items"] / best if best else None,
+                "us_per_token": best / case["tokens"] * 1e6 if case["tokens"] else None,
+                "peak_rss_mb": self.peak_rss_mb(),
+                "rss_growth_mb": self.peak_rss_mb() - rss_before,
+            }
+            if "counters" in case:
+                result["counters"] = dict(case["counters"])
+            return result
+        finally:
+            if "cleanup" in case:
+                shutil.rmtree(case["cleanup"], ignore_errors=True)
+
+    def environment(self):
+        try:
+            commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+        except OSError:
+            commit = None
+        return {
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "commit": commit,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        }
+
+    def run(self, names=None):
+        """ Runs the given cases (all by default) and returns the report """
+        names = list(self.cases) if names is None else names
+        report = {
+            "environment": self.environment(),
+            "settings": {"n_sentences": self.n_sentences, "sentence_length": self.sentence_length, "seed": self.seed,
+                         "repeats": self.repeats, "max_words": self.max_words, "models": self.models},
+            "results": {},
+        }
+        for name in names:
+            if self.isolate:
+                # a fresh process per case, so that the peak RSS is the case's own
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("fork")) as executor:
+                    result = executor.submit(_run_benchmark_case, self, name).result()
+            else:
+                result = self.run_case(name)
+            report["results"][name] = result
+            if "skipped" in result:
+                print(f"{name}: skipped ({result['skipped']})")
+            else:
+                print(f"{name}: {result['items_per_sec']:.1f} {result['unit']}s/sec, {result['us_per_token']:.2f} us/token, peak RSS {result['peak_rss_mb']:.1f} MB")
+        return report
+
+    def compare(self, baseline_file, current_file, tolerance=0.1):
+        """
+        Compares two reports case by case. Returns the cases whose throughput dropped by more than tolerance.
+        """
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)
+        with open(current_file, 'r') as f:
+            current = json.load(f)
+        if baseline["settings"] != current["settings"]:
+            print(f"Warning: the reports were made with different settings: {baseline['settings']} and {current['settings']}")
+
+        regressions = []
+        for name, result in current["results"].items():
+            old = baseline["results"].get(name)
+            if old is None or "skipped" in old or "skipped" in result:
+                continue
+            ratio = result["items_per_sec"] / old["items_per_sec"]
+            print(f"{name}: {ratio:.2f}x throughput, peak RSS {old['peak_rss_mb']:.1f} -> {result['peak_rss_mb']:.1f} MB")
+            if ratio < 1 - tolerance:
+                regressions.append(name)
+        return regressions
+
+    def main(self, out_file, names=None):
+        """
+        Runs the benchmark and writes the JSON report to out_file.
+        """
+        report = self.run(names)
+        with open(out_file, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print("Done!")
+        return report
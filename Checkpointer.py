@@ -0,0 +1,65 @@
+import os
+import json
+import pickle
+
+class Checkpointer(object):
+    """
+    Flushes the completed chunks of a long run to disk together with the input offset,
+    the RNG state and the counters, so that an interrupted run can be resumed where it stopped.
+    """
+    def __init__(self, folder, settings, resume=False):
+        self.folder = folder
+        self.state_file = folder + "/state.pkl"
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        if resume and os.path.exists(self.state_file):
+            with open(self.state_file, 'rb') as f:
+                self.state = pickle.load(f)
+            # the chunk boundaries and the seeding must not change between the runs
+            if self.state["settings"] != settings:
+                raise ValueError(f"Cannot resume: the checkpoint was made with {self.state['settings']}, not {settings}")
+        else:
+            # starting over
+            for name in os.listdir(folder):
+                if name.startswith("chunk_"):
+                    os.remove(folder + "/" + name)
+            self.state = {"settings": settings, "chunks": 0, "offset": 0, "rng_state": None, "counters": {}}
+
+    @property
+    def chunks(self):
+        return self.state["chunks"] # number of completed chunks
+
+    @property
+    def offset(self):
+        return self.state["offset"] # number of input lines behind the completed chunks
+
+    @property
+    def rng_state(self):
+        return self.state["rng_state"]
+
+    @property
+    def counters(self):
+        return self.state["counters"]
+
+    def atomic_write(self, path, data, mode='w'):
+        # writing next to the target and renaming, so a crash never leaves a half-written file
+        with open(path + ".tmp", mode) as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def save_chunk(self, records, offset, rng_state=None, counters=None):
+        """ Stores the records of the next chunk, then the state right after it """
+        self.atomic_write(f"{self.folder}/chunk_{self.chunks:06d}.json", json.dumps(records))
+        self.advance(offset, rng_state, counters)
+
+    def advance(self, offset, rng_state=None, counters=None):
+        """ Stores the state after the next chunk, whose records were written elsewhere (e.g. by a streaming run) """
+        self.state = dict(self.state, chunks=self.chunks + 1, offset=offset, rng_state=rng_state, counters=dict(counters or {}))
+        self.atomic_write(self.state_file, pickle.dumps(self.state), 'wb')
+
+    def load_chunks(self):
+        """ Yields the records of every completed chunk, in order """
+        for i in range(self.chunks):
+            with open(f"{self.folder}/chunk_{i:06d}.json", 'r') as f:
+                yield json.load(f)
@@ -0,0 +1,139 @@
+import os
+import json
+import numpy as np
+from array import array
+from collections import Counter
+
+class ColumnarWriter(object):
+    """
+    Writes tagged (tokens, labels) records in a columnar format instead of nested JSON.
+    Tokens and labels are interned into vocabularies shared by the splits, and every split is stored as flat
+    binary id arrays with sentence offsets, which ColumnarDataset memory-maps without parsing anything:
+    - vocab.json: {"tokens": [...], "labels": [...]}, the position of a string is its id;
+    - <split>.tokens.bin (uint32), <split>.labels.bin (uint16): the ids of all the sentences one after another;
+    - <split>.offsets.bin (int64): where every sentence starts, plus the total length at the end;
+    - meta.json: the dtypes and the sizes, written last, so its presence marks a complete dataset.
+    Used like SplitWriter: write(record, key) puts the record into train or dev by the hash of the key.
+    """
+    version = 1
+    dtypes = {"tokens": "uint32", "labels": "uint16", "offsets": "int64"}
+
+    def __init__(self, stream_handler, out_folder, splits=("train", "dev"), buffer_size=1 << 20):
+        self.stream_handler = stream_handler
+        self.out_folder = out_folder
+        self.buffer_size = buffer_size # ids kept in memory before a flush
+        self.counts = {split: 0 for split in splits}
+        self.token_ids, self.token_names = {}, []
+        self.label_ids, self.label_names = {}, []
+        self.files = {}
+        self.buffers = {}
+        self.lengths = {}
+
+    def __enter__(self):
+        if not os.path.exists(self.out_folder):
+            os.makedirs(self.out_folder)
+        # a dataset being written is not complete
+        if os.path.exists(self.out_folder + "/meta.json"):
+            os.remove(self.out_folder + "/meta.json")
+        for split in self.counts:
+            self.files[split] = {column: open(f"{self.out_folder}/{split}.{column}.bin", 'wb') for column in self.dtypes}
+            self.buffers[split] = {"tokens": array('I'), "labels": array('H'), "offsets": array('q', [0])}
+            self.lengths[split] = 0
+        return self
+
+    def intern(self, ids, names, value):
+        i = ids.get(value)
+        if i is None:
+            i = ids[value] = len(names)
+            names.append(value)
+        return i
+
+    def write_split(self, record, split):
+        tokens, labels = record
+        if len(tokens) != len(labels):
+            raise ValueError(f"{len(tokens)} tokens and {len(labels)} labels in a record")
+        buffers = self.buffers[split]
+        buffers["tokens"].extend([self.intern(self.token_ids, self.token_names, token) for token in tokens])
+        buffers["labels"].extend([self.intern(self.label_ids, self.label_names, label) for label in labels])
+        self.lengths[split] += len(tokens)
+        buffers["offsets"].append(self.lengths[split])
+        self.counts[split] += 1
+        if len(buffers["tokens"]) >= self.buffer_size:
+            self.flush(split)
+        return split
+
+    def write(self, record, key):
+        split = "dev" if self.stream_handler.is_dev(key) else "train"
+        return self.write_split(record, split)
+
+    def flush(self, split):
+        for column, buffer in self.buffers[split].items():
+            buffer.tofile(self.files[split][column])
+            del buffer[:]
+
+    def __exit__(self, exc_type, exc, tb):
+        for split in self.counts:
+            self.flush(split)
+            for f in self.files[split].values():
+                f.close()
+        if exc_type is not None:
+            return False
+        if len(self.label_names) > np.iinfo(np.uint16).max + 1:
+            raise ValueError(f"{len(self.label_names)} labels do not fit into uint16 ids")
+        with open(self.out_folder + "/vocab.json", 'w') as f:
+            json.dump({"tokens": self.token_names, "labels": self.label_names}, f, ensure_ascii=False)
+        meta = {"version": self.version, "dtypes": self.dtypes,
+                "splits": {split: {"sentences": self.counts[split], "tokens": self.lengths[split]} for split in self.counts}}
+        with open(self.out_folder + "/meta.json", 'w') as f:
+            json.dump(meta, f, indent=2)
+        return False
+
+class ColumnarDataset(object):
+    """
+    Memory-mapped view of a dataset written by ColumnarWriter; the id arrays are read with zero copies.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        with open(folder + "/meta.json", 'r') as f:
+            self.meta = json.load(f)
+        with open(folder + "/vocab.json", 'r') as f:
+            vocab = json.load(f)
+        self.token_names = vocab["tokens"]
+        self.label_names = vocab["labels"]
+        self.splits = {}
+        for split, sizes in self.meta["splits"].items():
+            self.splits[split] = {
+                "tokens": self.load(split, "tokens", sizes["tokens"]),
+                "labels": self.load(split, "labels", sizes["tokens"]),
+                "offsets": self.load(split, "offsets", sizes["sentences"] + 1),
+            }
+
+    def load(self, split, column, length):
+        if not length: # numpy cannot map an empty file
+            return np.zeros(0, dtype=self.meta["dtypes"][column])
+        return np.memmap(f"{self.folder}/{split}.{column}.bin", dtype=self.meta["dtypes"][column], mode='r', shape=(length,))
+
+    def __len__(self):
+        return sum(sizes["sentences"] for sizes in self.meta["splits"].values())
+
+    def sentence_ids(self, split, i):
+        """ The token and label ids of the i-th sentence of the split """
+        columns = self.splits[split]
+        start, end = columns["offsets"][i], columns["offsets"][i + 1]
+        return columns["tokens"][start:end], columns["labels"][start:end]
+
+    def record(self, split, i):
+        """ The i-th sentence of the split as a (tokens, labels) record """
+        token_ids, label_ids = self.sentence_ids(split, i)
+        return [self.token_names[t] for t in token_ids], [self.label_names[l] for l in label_ids]
+
+    def records(self, split):
+        for i in range(self.meta["splits"][split]["sentences"]):
+            yield self.record(split, i)
+
+    def label_counts(self, splits=None):
+        """ The number of every label, counted on the label id arrays """
+        counts = np.zeros(len(self.label_names), dtype=np.int64)
+        for split in (self.splits if splits is None else splits):
+            counts += np.bincount(self.splits[split]["labels"], minlength=len(self.label_names))
+        return Counter({self.label_names[i]: int(n) for i, n in enumerate(counts) if n})
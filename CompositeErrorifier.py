@@ -0,0 +1,154 @@
+import os
+import random
+import time
+import numpy as np
+from collections import Counter
+from StreamHandler import StreamHandler
+
+class CompositeErrorifier(object):
+    """
+    Runs several errorifiers over a single read of the corpus.
+    The corpus is read and chunked once, and every chunk is routed through the stages:
+    - mode="mixture": every sentence goes to exactly one stage, drawn with the stage probabilities as weights;
+    - mode="chain": the text stages are applied one after another, each to a sentence with its own probability.
+    In the mixture mode every stage writes its output to out_folder/<stage name> during the same pass;
+    the chain writes one source/target pair to out_folder.
+    """
+    def __init__(self, stages, probabilities=None, mode="mixture", seed=42, chunk_size=10000, replace_prob=0.01):
+        self.stages = list(stages.items()) # [(name, errorifier)], in order
+        if probabilities is None:
+            probabilities = [1.0 for stage in self.stages]
+        if len(probabilities) != len(self.stages):
+            raise ValueError("There must be one probability per stage")
+        if mode not in ("mixture", "chain"):
+            raise ValueError(f"Unknown mode {mode}, expected 'mixture' or 'chain'")
+        self.kinds = [self.stage_kind(errorifier) for name, errorifier in self.stages]
+        if mode == "chain" and "tagged" in self.kinds:
+            raise ValueError("Tagged errorifiers cannot be chained, use the mixture mode for them")
+        self.probabilities = np.array(probabilities, dtype=np.float64)
+        if mode == "mixture":
+            self.probabilities = self.probabilities / self.probabilities.sum()
+        self.mode = mode
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.replace_prob = replace_prob # word replacement probability of the russism stages
+        self.stream_handler = StreamHandler()
+
+    def stage_kind(self, errorifier):
+        # tagged stages produce (tokens, labels) records, text stages produce an errorified sentence
+        if hasattr(errorifier, "errorify_shard") or hasattr(errorifier, "errorify_chunk"):
+            return "tagged"
+        if any(hasattr(errorifier, method) for method in ("switch_words", "round_trip_many", "surzhify", "errorify_rus_dataset")):
+            return "text"
+        raise ValueError(f"{type(errorifier).__name__} is not a known errorifier")
+
+    def stage_seeds(self, chunk_id):
+        """
+        The seed of the routing generator and one seed per stage for a chunk, spawned from the master seed and the chunk id.
+        The stages derive their generators from the seed and the chunk id, so given the master seed they would
+        redraw the very numbers the routing drew.
+        """
+        children = np.random.SeedSequence([self.seed, chunk_id]).spawn(len(self.stages) + 1)
+        return children[0], [int(child.generate_state(1)[0]) for child in children[1:]]
+
+    def run_tagged_stage(self, errorifier, sentences, chunk_id, seed):
+        """ [(key, (tokens, labels))] for the sentences the stage could errorify """
+        if hasattr(errorifier, "errorify_shard"): # punctuation
+            if errorifier.sampler is None:
+                errorifier.generate_transfer_matrix()
+            return errorifier.errorify_shard(chunk_id, sentences, seed)
+        # grammar: the whole chunk is parsed in one batch
+        records, n_lines, unprocessed = errorifier.errorify_chunk(chunk_id, sentences, seed)
+        return records
+
+    def run_text_stage(self, errorifier, sentences, chunk_id, seed):
+        """ The errorified sentences, aligned with the input """
+        # the text errorifiers draw from the global random state
+        random.seed(seed)
+        if hasattr(errorifier, "invert_chunk"):
+            return errorifier.invert_chunk(sentences, chunk_id, seed)
+        if hasattr(errorifier, "round_trip_many"):
+            return errorifier.round_trip_many(sentences)
+        if hasattr(errorifier, "errorify_rus_dataset"):
+            return errorifier.errorify_rus_dataset(sentences, self.replace_prob)
+        if hasattr(errorifier, "surzhify"):
+            return [errorifier.surzhify(sentence) for sentence in sentences]
+        return [errorifier.switch_words(sentence) for sentence in sentences]
+
+    def open_outputs(self, out_folder):
+        if self.mode == "chain":
+            return [{"source": open(out_folder + "/source.txt", 'w'), "target": open(out_folder + "/target.txt", 'w'), "lines": 0}]
+        outputs = []
+        for (name, errorifier), kind in zip(self.stages, self.kinds):
+            stage_folder = out_folder + "/" + name
+            if not os.path.exists(stage_folder):
+                os.mkdir(stage_folder)
+            if kind == "tagged":
+                outputs.append({"writer": self.stream_handler.split_writer(stage_folder).__enter__(), "label_counts": Counter()})
+            else:
+                outputs.append({"source": open(stage_folder + "/source.txt", 'w'), "target": open(stage_folder + "/target.txt", 'w'), "lines": 0})
+        return outputs
+
+    def write_text(self, output, sources, targets):
+        for source, target in zip(sources, targets):
+            prefix = '\n' if output["lines"] else ''
+            output["source"].write(prefix + source)
+            output["target"].write(prefix + target)
+            output["lines"] += 1
+
+    def close_outputs(self, outputs, input_file, out_folder):
+        for (name, errorifier), output in zip(self.stages, outputs):
+            if "writer" in output:
+                output["writer"].__exit__(None, None, None)
+                n_sentences = sum(output["writer"].counts.values())
+                errorifier.write_metadata(output["label_counts"], n_sentences, input_file=input_file, out_folder=out_folder + "/" + name)
+            else:
+                output["source"].close()
+                output["target"].close()
+
+    def process_chunk(self, chunk_id, chunk, outputs):
+        routing_seed, seeds = self.stage_seeds(chunk_id)
+        rng = np.random.default_rng(routing_seed)
+        if self.mode == "mixture":
+            # routing every sentence to one stage
+            routes = rng.choice(len(self.stages), size=len(chunk), p=self.probabilities)
+            for stage_id, ((name, errorifier), kind, output) in enumerate(zip(self.stages, self.kinds, outputs)):
+                sentences = [chunk[i] for i in np.flatnonzero(routes == stage_id)]
+                if not sentences:
+                    continue
+                if kind == "tagged":
+                    for key, record in self.run_tagged_stage(errorifier, sentences, chunk_id, seeds[stage_id]):
+                        output["writer"].write(record, key)
+                        output["label_counts"].update(record[1])
+                else:
+                    self.write_text(output, self.run_text_stage(errorifier, sentences, chunk_id, seeds[stage_id]), sentences)
+            return
+
+        # chain: every stage errorifies a random part of what the previous stages produced
+        current = list(chunk)
+        for stage_id, (name, errorifier) in enumerate(self.stages):
+            selected = np.flatnonzero(rng.random(len(chunk)) < self.probabilities[stage_id])
+            if not len(selected):
+                continue
+            for i, sentence in zip(selected, self.run_text_stage(errorifier, [current[i] for i in selected], chunk_id, seeds[stage_id])):
+                current[i] = sentence
+        self.write_text(outputs[0], current, chunk)
+
+    def main(self, input_file, out_folder):
+        """
+        Reads the corpus once and writes the outputs of all the stages.
+        """
+        if not os.path.exists(out_folder):
+            os.mkdir(out_folder)
+
+        t0 = time.time()
+        n_lines = 0
+        outputs = self.open_outputs(out_folder)
+        try:
+            for chunk_id, chunk in enumerate(self.stream_handler.chunked(self.stream_handler.read_lines(input_file), self.chunk_size)):
+                self.process_chunk(chunk_id, chunk, outputs)
+                n_lines += len(chunk)
+                print(f"{n_lines} sentences were processed in {(time.time() - t0)/3600:.2} hours")
+        finally:
+            self.close_outputs(outputs, input_file, out_folder)
+        print("Done!")
@@ -1,53 +1,190 @@
-import spacy_udpipe
-import pymorphy2
 import os
 import time
 import json
 import random
 import sys
-import pandas as pd
 from datetime import datetime
-from collections import Counter
-from sklearn.model_selection import train_test_split
+from array import array
+from itertools import compress, islice
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter, namedtuple
 from helpers.classes.SpaceHandler import SpaceHandler
-from helpers.classes.Inflector import Inflector
-from helpers.classes.GrammarInterpreter import GrammarInterpreter
+from StreamHandler import StreamHandler
+from Checkpointer import Checkpointer
+from Instrumentation import Instrumentation
+from ColumnarDataset import ColumnarDataset
+from SentenceIndex import SentenceIndex
+from ResultCache import ResultCache, file_version
+from ModelRegistry import LazyModule, LazyModel, shared_models, lazy_models, fork_context, process_memory
 
+# the parser and the morphology are imported on first use
+spacy_udpipe = LazyModule("spacy_udpipe")
+pymorphy2 = LazyModule("pymorphy2")
+Inflector = LazyModule("helpers.classes.Inflector", "Inflector")
+GrammarInterpreter = LazyModule("helpers.classes.GrammarInterpreter", "GrammarInterpreter")
+UDPIPE_MODEL = "helpers.models.ukrainian-iu-ud-2.5-191206.udpipe"
+
+# a token of a cached parse, read like a spacy token
+ParsedToken = namedtuple("ParsedToken", ["text", "pos_"])
+
+# the errorifier of a worker process, loaded once by the pool initializer
+_worker_errorifier = None
+
+def _init_grammar_worker(init_kwargs, settings, models=None):
+    global _worker_errorifier
+    _worker_errorifier = GrammarErrofifier(models=models, **init_kwargs)
+    # the hyperparameters set on the parent after it was built
+    for name, value in settings.items():
+      setattr(_worker_errorifier, name, value)
+
+def _errorify_grammar_chunk(chunk):
+    # the chunk and the timings and counters it took
+    result = _worker_errorifier.errorify_chunk(*chunk)
+    # how much of the worker is still shared with the parent that preloaded the models
+    memory = process_memory()
+    for name in ("shared_mb", "private_mb"):
+        if name in memory:
+            _worker_errorifier.instrumentation.gauge("worker_" + name, memory[name])
+    return result, _worker_errorifier.instrumentation.take()
+
+class SentenceRecord(object):
+    """
+    Columns of a sentence being errorified: the tokens, interned label and POS ids, and conjugable/preposition flags.
+    """
+    __slots__ = ("tokens", "label_ids", "pos_ids", "conjugables", "prepositions")
+
+    def compact(self, mask):
+      # dropping the masked out positions from every column in one pass over the mask
+      self.tokens = list(compress(self.tokens, mask))
+      self.label_ids = array('H', compress(self.label_ids, mask))
+      self.pos_ids = array('H', compress(self.pos_ids, mask))
+      self.conjugables = bytearray(compress(self.conjugables, mask))
+      self.prepositions = bytearray(compress(self.prepositions, mask))
 
 class GrammarErrofifier(object):
     """
     Makes tagged and human-readable grammar errors in data.
     """
-    def __init__(self):
-      self.morph = pymorphy2.MorphAnalyzer(lang='uk')
+    # the models are loaded from the registry on first use
+    morph = LazyModel("pymorphy2:uk")
+    inflector = LazyModel("inflector:uk")
+    grammar_interpreter = LazyModel("grammar-interpreter:uk")
+    spacy_model = LazyModel("udpipe:" + UDPIPE_MODEL)
+    vidm_choices = LazyModel("vidm-choices:uk")
+    vidm_descriptions = LazyModel("vidm-descriptions:uk")
+
+    def __init__(self, batch_size=256, n_process=1, cache_size=200000, models=None, cache_path=None):
+      self.init_kwargs = {"batch_size": batch_size, "n_process": 1, "cache_size": cache_size, "cache_path": cache_path} # how the workers build their own copy
+      self.rng = random # the global generator unless a chunk sets its own
       self.space_handler = SpaceHandler()
-      self.inflector = Inflector(self.morph)
-      self.grammar_interpreter = GrammarInterpreter(self.space_handler, self.inflector)
-      self.spacy_model = SPACY_UDPIPE_MODEL = spacy_udpipe.load_from_path(
-          lang="uk",
-          path="helpers.models.ukrainian-iu-ud-2.5-191206.udpipe"
-          )
+      self.stream_handler = StreamHandler()
+      self.models = shared_models if models is None else models # shared with the other errorifiers of the process by default
+      self.models.register("pymorphy2:uk", lambda models: pymorphy2.MorphAnalyzer(lang='uk'))
+      self.models.register("inflector:uk", lambda models: Inflector(models.get("pymorphy2:uk")))
+      self.models.register("grammar-interpreter:uk", lambda models: GrammarInterpreter(SpaceHandler(), models.get("inflector:uk")))
+      self.models.register("udpipe:" + UDPIPE_MODEL, lambda models: spacy_udpipe.load_from_path(lang="uk", path=UDPIPE_MODEL))
+      # the cases and their descriptions are split into sets once instead of on every lookup
+      self.models.register("vidm-choices:uk", lambda models: {pos: list(d.keys()) for pos, d in models.get("inflector:uk").d_straight.items()})
+      self.models.register("vidm-descriptions:uk", lambda models: {pos: [(frozenset(key.split()), vidm) for key, vidm in d.items()]
+                                                                   for pos, d in models.get("inflector:uk").d_reverse.items()})
       self.matchings = {"PROPN":"NOUN","NOUN":"NOUN", "VERB":"VERB", "PRON":"NPRO", "DET":"NPRO","ADJ":"ADJF", "NUM":"NUMR"} #match POS for inflector to be readable
       self.p_mispreposition = 0.8 # preposition error probability
       self.p_misconjugation = 0.5 # misconjugation probability
       self.t_prep = tuple(["від", "для", "по", "через", "при", "про","згідно", "над",
           "під", "до", "з", "ради", "із", "зі", "на", "при", "за", "в", 
           "на", "з-за", "із-за", "щодо", "крім", "між", "перед", "біля"]) # list of preposition to preposition errors
+      self.settings = ("matchings", "p_mispreposition", "p_misconjugation", "t_prep") # the hyperparameters passed to the workers
+      self.batch_size = batch_size # number of sentences parsed by one nlp.pipe batch
+      self.n_process = n_process # number of processes used by nlp.pipe
+      # interned labels and POS tags of the sentence records
+      self.label_ids, self.label_names, self.append_labels = {}, [], []
+      self.pos_ids, self.pos_names, self.conjugable_pos = {}, [], []
+      self.keep_id = self.label_id('$KEEP')
+      # bounded LRU caches of the morphology, keyed on (pos, word) and (word, case, pos)
+      self.vidm_cache = lru_cache(maxsize=cache_size)(self.lookup_vidm)
+      self.inflection_cache = lru_cache(maxsize=cache_size)(self.lookup_inflection)
+      # per-stage timers and counters, with the hit rates of the caches
+      self.instrumentation = Instrumentation()
+      self.instrumentation.watch_cache("vidm", lambda: tuple(self.vidm_cache.cache_info()[:2]))
+      self.instrumentation.watch_cache("inflection", lambda: tuple(self.inflection_cache.cache_info()[:2]))
+      # the parses kept on disk between the runs, so that only the sampling is redone for other probabilities
+      self.parse_cache = None
+      if cache_path is not None:
+        self.parse_cache = ResultCache(cache_path, "udpipe-parse", file_version(UDPIPE_MODEL))
+        self.instrumentation.watch_cache("parse", self.parse_cache.stats)
 
     "finds vidminok of a word given pos, word. uses inflector"
     def find_vidm(self, pos, word):
-      descr = self.inflector.describe_word(pos, word)
-      d = self.inflector.d_reverse[pos] # the dictionary of converting raw description to a tag
-      seq = list()
-      for i in d.keys():
-        seq.append(len(set(i.split()) & descr)) 
-      return d[list(d.keys())[seq.index(max(seq))]] #шукає найбільше співпадіння між describe_word та словником описів відмінків
-
-    "splits text into (word, pos). uses spacy"
-    def split_by_words(self, text):
+      vidm = self.vidm_cache(pos, word)
+      if vidm is None:
+        raise ValueError(f"Could not describe {word} as {pos}")
+      return vidm
+
+    "uncached find_vidm. failures are returned as None so that they get cached too"
+    def lookup_vidm(self, pos, word):
+      try:
+        descr = self.inflector.describe_word(pos, word)
+      except Exception:
+        return None
+      best_vidm, best_overlap = None, -1
+      for description, vidm in self.vidm_descriptions[pos]:
+        overlap = len(description & descr)
+        if overlap > best_overlap: #шукає найбільше співпадіння між describe_word та словником описів відмінків
+          best_vidm, best_overlap = vidm, overlap
+      return best_vidm
+
+    "inflects a word into the given case. uses the inflection cache"
+    def inflect_word(self, word, vidm, pos):
+      new_word = self.inflection_cache(word, vidm, pos)
+      if new_word is None:
+        raise ValueError(f"Could not inflect {word} into {vidm}")
+      return new_word
+
+    "uncached inflect_word. failures are returned as None so that they get cached too"
+    def lookup_inflection(self, word, vidm, pos):
+      try:
+        return self.inflector.inflect_word(word, vidm, pos)
+      except Exception:
+        return None
+
+    "hit/miss counters of the morphology caches"
+    def cache_stats(self):
+      stats = {}
+      for name, cache in (("vidm", self.vidm_cache), ("inflection", self.inflection_cache)):
+        info = cache.cache_info()
+        lookups = info.hits + info.misses
+        stats[name] = {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize,
+                       "hit_rate": info.hits / lookups if lookups else 0.0}
+      return stats
+
+    "parses a chunk of sentences, taking the parses cached by earlier runs. None stands for a sentence to be parsed on its own"
+    def parse_sentences(self, sentences):
+      if self.parse_cache is None:
+        return self.pipe_sentences(sentences)
+      parses = self.parse_cache.get_many(sentences)
+      missing = [sentence for sentence in dict.fromkeys(sentences) if sentence not in parses]
+      if missing:
+        parsed = {sentence: [(token.text, token.pos_) for token in doc]
+                  for sentence, doc in zip(missing, self.pipe_sentences(missing)) if doc is not None}
+        self.parse_cache.put_many(parsed)
+        parses.update(parsed)
+      return [None if sentence not in parses else [ParsedToken(*token) for token in parses[sentence]] for sentence in sentences]
+
+    "parses a chunk of sentences with one batched nlp.pipe call. yields None for every sentence if the batch fails"
+    def pipe_sentences(self, sentences):
+      try:
+        return list(self.spacy_model.pipe(sentences, batch_size=self.batch_size, n_process=self.n_process))
+      except Exception:
+        return [None for sentence in sentences] # the sentences will be parsed one by one
+
+    "splits text into (word, pos). uses spacy unless the parsed doc is given"
+    def split_by_words(self, text, doc=None):
+      if doc is None:
+        doc = self.spacy_model(text)
       i = 0
       splitted_by_words = [('$START', 'PUNCT')] # we'll treat the starting token as punctuation to not trigger the mova-institute model
-      for token in self.spacy_model(text):
+      for token in doc:
         splitted_by_words.append([
           token.text, #оригінал
           token.pos_, # частина мови
@@ -55,142 +192,183 @@ class GrammarErrofifier(object):
         i += 1
       return splitted_by_words
 
+    "interns a label string, returning its id"
+    def label_id(self, label):
+      label_id = self.label_ids.get(label)
+      if label_id is None:
+        label_id = self.label_ids[label] = len(self.label_names)
+        self.label_names.append(label)
+        self.append_labels.append(label.startswith('$APPEND'))
+      return label_id
+
+    "interns a POS tag, returning its id"
+    def pos_id(self, pos):
+      pos_id = self.pos_ids.get(pos)
+      if pos_id is None:
+        pos_id = self.pos_ids[pos] = len(self.pos_names)
+        self.pos_names.append(pos)
+        self.conjugable_pos.append(pos in self.matchings)
+      return pos_id
+
     # helper functions
     # moving appends to the previous tokens
-    def append_fix(self, tokens, labels, pos_seqs, conjugables, prepositions):
-      labels_new = []
-      for i in range(len(labels)):
-        # if it is an append, then move it to the previous tag
-        if labels[i].startswith('$APPEND'):
-          labels_new[i-1] = labels[i]
-        # and then append the existing tag
-        labels_new.append(labels[i])
-      return tokens, labels_new, pos_seqs, conjugables, prepositions
+    def append_fix(self, record):
+      label_ids = record.label_ids
+      for i in range(1, len(label_ids)):
+        # if it is an append, then move it to the previous tag (the token itself keeps it too)
+        if self.append_labels[label_ids[i]]:
+          label_ids[i-1] = label_ids[i]
+      return record
 
     # removing empty tokens
-    def remove_empty_tokens(self, tokens, labels, pos_seqs, conjugables, prepositions):
-      tokens_new = [tokens[i] for i in range(len(tokens)) if tokens[i] != ''] # if a token is empty, it would not be added
-      labels_new = [labels[i] for i in range(len(labels)) if tokens[i] != ''] # repeat everything for all other elements
-      pos_seqs_new = [pos_seqs[i] for i in range(len(pos_seqs)) if tokens[i] != '']
-      conjugables_new = [conjugables[i] for i in range(len(conjugables)) if tokens[i] != '']
-      prepositions_new = [prepositions[i] for i in range(len(prepositions)) if tokens[i] != '']
-      return tokens_new, labels_new, pos_seqs_new, conjugables_new, prepositions_new
+    def remove_empty_tokens(self, record):
+      record.compact([token != '' for token in record.tokens]) # if a token is empty, it would not be kept
+      return record
 
     # preparing the sentence for future errorifying
-    def prepare_sentence(self, sentence):
-      tokens_and_pos = self.split_by_words(sentence) #use mova_institute to get tokens and part of speech for every word
-      tokens =  [i[0] for i in tokens_and_pos]
-      pos_seq = [i[1] for i in tokens_and_pos]
-      conjugables = [pos in set(self.matchings) for pos in pos_seq]
-      prepositions = [token.lower() in self.t_prep for token in tokens]
-      labels = ['$KEEP' for i in range(len(tokens))]
-      return tokens, labels, pos_seq, conjugables, prepositions
+    def prepare_sentence(self, sentence, doc=None):
+      tokens_and_pos = self.split_by_words(sentence, doc) #use mova_institute to get tokens and part of speech for every word
+      record = SentenceRecord()
+      record.tokens = [i[0] for i in tokens_and_pos]
+      record.pos_ids = array('H', [self.pos_id(i[1]) for i in tokens_and_pos])
+      record.label_ids = array('H', [self.keep_id]) * len(record.tokens)
+      record.conjugables = bytearray(self.conjugable_pos[pos_id] for pos_id in record.pos_ids)
+      record.prepositions = bytearray(token.lower() in self.t_prep for token in record.tokens)
+      return record
 
     # making an error in conjuctions
-    def make_conjugable_error(self, token, label, pos_seq, conjugable, preposition): # TAKES IN ONE WORD'S PROPERTIES
-      pos = self.matchings[pos_seq] # convert to morph POS tags
-      l = list(self.inflector.d_straight[pos].keys()) #список усіх відмінювань для частини мови даного слова
-      vidm = l[random.randrange(1, len(l)-1)] #random case minus the default one and callings to fix the bug with plurals
+    def make_conjugable_error(self, record, i): # TAKES IN ONE WORD OF THE SENTENCE
+      token = record.tokens[i]
+      pos = self.matchings[self.pos_names[record.pos_ids[i]]] # convert to morph POS tags
+      l = self.vidm_choices[pos] #список усіх відмінювань для частини мови даного слова
+      vidm = l[self.rng.randrange(1, len(l)-1)] #random case minus the default one and callings to fix the bug with plurals
       try: # if we can identify the original vidm
         new_label = "$TRANSFORM_" + pos + "_" + self.find_vidm(pos, token)
-        new_token = self.inflector.inflect_word(token, vidm, pos)
-        if token != new_token:
-          return new_token, new_label, pos_seq, conjugable, preposition # return the errorified token + tag
-        else: #if landed on the same one
-          return token, label, pos_seq, conjugable, preposition # nothing changes
+        new_token = self.inflect_word(token, vidm, pos)
       except: # if can't identify vidm
-        return token, label, pos_seq, conjugable, preposition # nothing changes
+        return record # nothing changes
+      if token != new_token: # put the errorified token + tag
+        record.tokens[i] = new_token
+        record.label_ids[i] = self.label_id(new_label)
+      return record # if landed on the same one, nothing changes
 
     # make an error in prepositions
-    def make_preposition_error(self, token, label, pos_seq, conjugable, preposition): # TAKES IN ONE WORD'S PROPERTIES
-      x = random.random()
+    def make_preposition_error(self, record, i): # TAKES IN ONE WORD OF THE SENTENCE
+      token = record.tokens[i]
+      x = self.rng.random()
       if x < 0.6: # make deletes a little more likely than replaces
-        label = f'$APPEND_{token.lower()}'
-        token = ''
+        record.label_ids[i] = self.label_id(f'$APPEND_{token.lower()}')
+        record.tokens[i] = ''
       else: # if replace
-        new = preps[random.randint(0, len(preps)-1)] #appennd random propostions
-        if new in t_prep and new != token.lower(): #catches some weird bug
-          label = f'$REPLACE_{token.lower()}'
-          token = new
-      return token, label, pos_seq, conjugable, preposition
+        new = self.t_prep[self.rng.randint(0, len(self.t_prep)-1)] #appennd random propostions
+        if new != token.lower(): # the same preposition is not an error
+          record.label_ids[i] = self.label_id(f'$REPLACE_{token.lower()}')
+          record.tokens[i] = new
+      return record
 
     # combine all the errorifying functions and apply them to a sentence
-    def errorify_sentence(self, sentence):
+    def errorify_sentence(self, sentence, doc=None):
+      t0 = time.perf_counter()
       # dissect the words by properties
-      tokens, labels, pos_seq, conjugables, prepositions = self.prepare_sentence(sentence)
+      record = self.prepare_sentence(sentence, doc)
+      t1 = time.perf_counter()
+      label_ids = record.label_ids
       # for each element (word/punct)
-      for i in range(1, len(tokens)):
+      for i in range(1, len(record.tokens)):
         # probability error
-        p_error = random.random()
+        p_error = self.rng.random()
         # if it is a preposition and no tag has been applied to the previous token, make a preposition error
-        if prepositions[i] and labels[i-1] == '$KEEP' and p_error <= self.p_mispreposition:
-          tokens[i], labels[i], pos_seq[i], conjugables[i], prepositions[i] = self.make_preposition_error(tokens[i], labels[i], pos_seq[i], conjugables[i], prepositions[i])
+        if record.prepositions[i] and label_ids[i-1] == self.keep_id and p_error <= self.p_mispreposition:
+          self.make_preposition_error(record, i)
         # if we can misconjunct the word and it does not have any appends, then make a conjugation error
-        if conjugables[i] and labels[i] == '$KEEP' and p_error <= self.p_misconjugation:
-          tokens[i], labels[i], pos_seq[i], conjugables[i], prepositions[i] = self.make_conjugable_error(tokens[i], labels[i], pos_seq[i], conjugables[i], prepositions[i])
+        if record.conjugables[i] and label_ids[i] == self.keep_id and p_error <= self.p_misconjugation:
+          self.make_conjugable_error(record, i)
       # append fix
-      tokens, labels, pos_seq, conjugables, prepositions = self.append_fix(tokens, labels, pos_seq, conjugables, prepositions)
+      self.append_fix(record)
       # remove the empty tokens
-      tokens, labels, pos_seq, conjugables, prepositions = self.remove_empty_tokens(tokens, labels, pos_seq, conjugables, prepositions)
-      assert len(tokens) == len(labels)
-      return tokens, labels
+      self.remove_empty_tokens(record)
+      assert len(record.tokens) == len(record.label_ids)
+      self.instrumentation.add_time("prepare", t1 - t0)
+      self.instrumentation.add_time("errorify", time.perf_counter() - t1)
+      return record.tokens, [self.label_names[label_id] for label_id in record.label_ids]
 
-    def main(self, input_file, out_folder):
-      # creating the output folder
-      if not os.path.exists(out_folder):
-        os.mkdir(out_folder)
-
-      # reading the file
-      with open(input_file, 'r') as f:
-        text = f.read()
-        lines = text.split('\n')
-        lines = lines[:500000]
-
-      final_list = []
-      t0 = time.time()
-      misinterpreted_counter = 0
-      unprocessed_counter = 0
+    "errorifies the lines chunk by chunk, parsing every chunk in one batch. yields None for the sentences that could not be processed"
+    def errorify_lines(self, lines, chunk_size=10000):
+      for chunk in self.stream_handler.chunked(lines, chunk_size):
+        with self.instrumentation.timer("parse"):
+          docs = self.parse_sentences(chunk)
+        for sentence, doc in zip(chunk, docs):
+          # try except loop to catch the sentences not processed by pymorphy
+          try:
+            errorified = self.errorify_sentence(sentence, doc)
+          except Exception:
+            self.instrumentation.count("pymorphy_failures")
+            errorified = None
+          # yielding outside the try, so closing the generator is not taken for a failure
+          yield sentence, errorified
 
-      # traversing through the list
-      for i in range(len(lines)):
-        sentence = lines[i]
-        # making the error
-        # try except loop to catch the sentences not processed by pymorphy
-        try:
-          errorified = self.errorify_sentence(sentence)
-          # adding the sentence to the list
-          final_list.append(errorified)
-        except:
+    "errorifies one chunk with its own generator derived from the seed and the chunk id"
+    def errorify_chunk(self, chunk_id, lines, seed=42):
+      self.rng = random.Random(f"{seed}:{chunk_id}")
+      try:
+        records = []
+        unprocessed_counter = 0
+        for sentence, errorified in self.errorify_lines(lines, chunk_size=len(lines)):
+          if errorified is None:
             unprocessed_counter += 1
-        # estimating the time left
-        if i != 0 and not i % 10000:
-            print(f"{i} sentences were processed\nProjected time till the end: {(time.time() - t0)/3600/i*(len(lines)-i):.2} hours")
+          else:
+            records.append((sentence, errorified))
+        return records, len(lines), unprocessed_counter
+      finally:
+        self.rng = random
 
-      # splitting the dataset into train and dev
-      train, dev = train_test_split(final_list, test_size=0.2, random_state=47)
+    def report_models(self):
+      # the resident memory taken by every loaded model, next to the other gauges of the run
+      for name, usage in self.models.memory.items():
+        if usage["rss_mb"] is not None:
+          self.instrumentation.gauge("model_rss_mb:" + name, usage["rss_mb"])
 
-      # showing the results
-      print("Out of 500, " + str(unprocessed_counter) + " sentences were not processed by Pymorphy and way too many could not be interpreted correctly.")
+    def errorified_chunks(self, lines, workers=None, seed=42, chunk_size=10000, first_chunk=0):
+      """
+      Yields (records, number of lines, number of unprocessed lines) for every chunk of the input, in input order.
+      first_chunk is the id of the first chunk, for resuming a run.
+      With workers=None the chunks use the global random state. With workers=N every chunk has its own
+      deterministic generator and the chunks are spread over N processes; the models are loaded before
+      the processes are forked, so that they share them. The output is the same for any N.
+      """
+      chunks = self.stream_handler.chunked(lines, chunk_size)
+      if workers is None:
+        for chunk in chunks:
+          records = [(sentence, errorified) for sentence, errorified in self.errorify_lines(chunk, chunk_size) if errorified is not None]
+          yield records, len(chunk), len(chunk) - len(records)
+        return
 
-      # saving the train and the dev datasets
-      with open(out_folder + "/train.json", 'w') as f:
-          json.dump(train, f) 
-
-      with open(out_folder + "/dev.json", 'w') as f:
-          json.dump(dev, f)
-
-      "LABEL COUNTER"
-      all_labels = []
-      for sent in final_list:
-        for label in sent[1]:
-          all_labels.append(label)
-
-      # count each label type
-      label_counts = dict(Counter(all_labels).items())
-      label_counts = dict(sorted(label_counts.items(), key=lambda item: item[1], reverse=True))
+      jobs = ((chunk_id, chunk, seed) for chunk_id, chunk in enumerate(chunks, first_chunk))
+      if workers <= 1:
+        for job in jobs:
+          yield self.errorify_chunk(*job)
+        return
 
+      # the workers are forked with the models in place instead of loading a copy each
+      self.models.preload(lazy_models(self))
+      context = fork_context()
+      settings = {name: getattr(self, name) for name in self.settings}
+      # a forked worker gets the registry itself, a spawned one cannot pickle its loaders and uses the shared registry
+      models = self.models if context is not None else None
+      try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_grammar_worker, initargs=(self.init_kwargs, settings, models)) as executor:
+          for result, counts in self.stream_handler.ordered_map(executor, _errorify_grammar_chunk, jobs, 2 * workers,
+                                                                depth=lambda n: self.instrumentation.gauge("pending_chunks", n)):
+            self.instrumentation.merge(counts) # timed in a worker
+            yield result
+      finally:
+        # the workers are gone, the parent collects its garbage again
+        self.models.unfreeze()
 
+    def write_metadata(self, label_counts, n_sentences, *, input_file, out_folder):
       "METADATA WRITER"
+      label_counts = dict(sorted(label_counts.items(), key=lambda item: item[1], reverse=True))
       # saving the metadata
       message = "########## Preprocess info ##########\n"
 
@@ -202,10 +380,10 @@ class GrammarErrofifier(object):
       message += f"Sample used: {input_file}\n"
 
       # writing the sentences size
-      message += f"Number of sentences : {len(final_list)}\n"
+      message += f"Number of sentences : {n_sentences}\n"
 
       # writing the tokens size
-      message += f"Number of tokens/tags : {len(all_labels)}\n"
+      message += f"Number of tokens/tags : {sum(label_counts.values())}\n"
 
       # writing the label vocab size
       message += f"Number of unique labels : {len(label_counts)}\n"
@@ -220,4 +398,181 @@ class GrammarErrofifier(object):
       with open(out_folder + '/metadata.txt', 'w') as final_file:
         final_file.write(message)
 
-      print("Done!")
\ No newline at end of file
+    def main(self, input_file, out_folder, stream=False, workers=None, max_lines=None, chunk_size=10000, checkpoint=False, resume=False, stats=False, columnar=False,
+             dedup=False, dedup_index=None):
+      """
+      stream=True reads the input lazily and writes train.jsonl/dev.jsonl as the sentences are errorified.
+      workers=N errorifies the input on N processes with per-chunk seeding.
+      max_lines limits the number of lines read from the input.
+      checkpoint=True flushes every completed chunk to out_folder/checkpoints; resume=True continues
+      from the last flushed chunk and gives the same output as an uninterrupted run. With stream=True
+      only the input offset and the sizes of the output files are flushed, and a resumed run appends to the files.
+      stats=True writes periodic snapshots of the stage timings, counters and cache hit rates to stats.jsonl
+      and their totals to stats-summary.json.
+      columnar=True writes the train and dev sets as memory-mappable id arrays to out_folder/columnar (see ColumnarDataset)
+      instead of train.json/dev.json.
+      dedup=True skips empty lines and duplicate sentences before parsing them; with dedup_index, a path to an .npy file,
+      the sentences seen by earlier runs are skipped too and the index is updated at the end (see SentenceIndex).
+      """
+      if stream:
+        return self.main_stream(input_file, out_folder, workers, max_lines, stats, columnar, dedup, dedup_index, chunk_size, checkpoint, resume)
+
+      # creating the output folder
+      if not os.path.exists(out_folder):
+        os.mkdir(out_folder)
+
+      # reading the file
+      with open(input_file, 'r') as f:
+        text = f.read()
+        lines = text.split('\n')
+        lines = lines[:max_lines]
+
+      # skipping the empty lines and the sentences seen before
+      index = SentenceIndex(dedup_index) if dedup or dedup_index else None
+      if index is not None:
+        lines = index.filter(lines)
+
+      final_list = []
+      n_lines = 0
+      unprocessed_counter = 0
+      first_chunk = 0
+
+      checkpointer = None
+      if checkpoint or resume:
+        settings = {"input_file": input_file, "max_lines": max_lines, "chunk_size": chunk_size, "seeded_chunks": workers is not None}
+        if index is not None: # the deduplicated lines are chunked differently
+          settings["dedup"] = True
+        checkpointer = Checkpointer(out_folder + "/checkpoints", settings, resume)
+        # continuing after the completed chunks
+        n_lines, first_chunk = checkpointer.offset, checkpointer.chunks
+        unprocessed_counter = checkpointer.counters.get("unprocessed", 0)
+        if checkpointer.rng_state is not None:
+          random.setstate(checkpointer.rng_state)
+      start = n_lines
+      if stats:
+        self.instrumentation.snapshot_file = out_folder + "/stats.jsonl"
+      self.instrumentation.start(total=len(lines), done=start)
+
+      # traversing through the list chunk by chunk
+      for records, chunk_lines, chunk_unprocessed in self.errorified_chunks(lines[start:], workers, chunk_size=chunk_size, first_chunk=first_chunk):
+        n_lines += chunk_lines
+        unprocessed_counter += chunk_unprocessed
+        if checkpointer is not None:
+          # the global random state matters only when the chunks are not seeded on their own
+          rng_state = random.getstate() if workers is None else None
+          with self.instrumentation.timer("checkpoint"):
+            checkpointer.save_chunk([errorified for sentence, errorified in records], n_lines, rng_state, {"unprocessed": unprocessed_counter})
+        else:
+          # adding the sentences to the list
+          final_list.extend(errorified for sentence, errorified in records)
+        # reporting the progress and the time left
+        self.instrumentation.progress(n_lines)
+      self.instrumentation.progress(n_lines, force=True)
+
+      if checkpointer is not None:
+        final_list = [errorified for records in checkpointer.load_chunks() for errorified in records]
+
+      # splitting the dataset into train and dev
+      from sklearn.model_selection import train_test_split # only the non-streaming split needs sklearn
+      train, dev = train_test_split(final_list, test_size=0.2, random_state=47)
+
+      # showing the results
+      print("Out of " + str(n_lines) + ", " + str(unprocessed_counter) + " sentences were not processed by Pymorphy.")
+
+      with self.instrumentation.timer("write"):
+        if columnar:
+          # saving the train and the dev datasets as id arrays
+          with self.stream_handler.split_writer(out_folder, columnar=True) as writer:
+            for split, records in (("train", train), ("dev", dev)):
+              for record in records:
+                writer.write_split(record, split)
+          # counting the labels on the label id arrays
+          label_counts = ColumnarDataset(writer.out_folder).label_counts()
+        else:
+          # saving the train and the dev datasets
+          with open(out_folder + "/train.json", 'w') as f:
+              json.dump(train, f) 
+
+          with open(out_folder + "/dev.json", 'w') as f:
+              json.dump(dev, f)
+
+          "LABEL COUNTER"
+          label_counts = Counter()
+          for sent in final_list:
+            label_counts.update(sent[1])
+
+        self.write_metadata(label_counts, len(final_list), input_file=input_file, out_folder=out_folder)
+
+      if index is not None:
+        index.finish()
+      if stats:
+        self.report_models()
+        self.instrumentation.summary(out_folder + "/stats-summary.json")
+      print("Done!")
+
+    def main_stream(self, input_file, out_folder, workers=None, max_lines=None, stats=False, columnar=False, dedup=False, dedup_index=None,
+                    chunk_size=10000, checkpoint=False, resume=False):
+      """
+      Streaming driver: the corpus is read line by line and every errorified sentence is written right away.
+      With checkpoint/resume, see main.
+      """
+      label_counts = Counter()
+      n_lines = 0
+      unprocessed_counter = 0
+      if not os.path.exists(out_folder):
+        os.mkdir(out_folder)
+
+      lines = self.stream_handler.read_lines(input_file, max_lines)
+      # skipping the empty lines and the sentences seen before
+      index = SentenceIndex(dedup_index) if dedup or dedup_index else None
+      if index is not None:
+        lines = index.filter_lines(lines)
+
+      checkpointer = None
+      writer_state = None
+      first_chunk = 0
+      if checkpoint or resume:
+        if columnar:
+          raise ValueError("A streaming run with checkpoints writes JSON Lines, it cannot be combined with columnar=True")
+        settings = {"input_file": input_file, "max_lines": max_lines, "chunk_size": chunk_size, "seeded_chunks": workers is not None,
+                    "stream": True, "dedup": index is not None}
+        checkpointer = Checkpointer(out_folder + "/checkpoints", settings, resume)
+        n_lines, first_chunk = checkpointer.offset, checkpointer.chunks
+        unprocessed_counter = checkpointer.counters.get("unprocessed", 0)
+        label_counts.update(checkpointer.counters.get("labels", {}))
+        writer_state = checkpointer.counters.get("writer")
+        if checkpointer.rng_state is not None:
+          random.setstate(checkpointer.rng_state)
+        # the lines of the completed chunks are skipped; they still go through the index, which sees them again as on the first run
+        lines = islice(lines, n_lines, None)
+      if stats:
+        self.instrumentation.snapshot_file = out_folder + "/stats.jsonl"
+      self.instrumentation.start(total=max_lines, done=n_lines)
+
+      with self.stream_handler.split_writer(out_folder, columnar=columnar, state=writer_state) as writer:
+        for records, chunk_lines, chunk_unprocessed in self.errorified_chunks(lines, workers, chunk_size=chunk_size, first_chunk=first_chunk):
+          with self.instrumentation.timer("write"):
+            for sentence, errorified in records:
+              writer.write(errorified, key=sentence)
+              if not columnar: # counted on the label id arrays instead
+                label_counts.update(errorified[1])
+          n_lines += chunk_lines
+          unprocessed_counter += chunk_unprocessed
+          if checkpointer is not None:
+            # the global random state matters only when the chunks are not seeded on their own
+            rng_state = random.getstate() if workers is None else None
+            with self.instrumentation.timer("checkpoint"):
+              checkpointer.advance(n_lines, rng_state, {"unprocessed": unprocessed_counter, "labels": dict(label_counts), "writer": writer.state()})
+          self.instrumentation.progress(n_lines)
+      self.instrumentation.progress(n_lines, force=True)
+
+      print("Out of " + str(n_lines) + ", " + str(unprocessed_counter) + " sentences were not processed by Pymorphy.")
+      if columnar:
+        label_counts = ColumnarDataset(writer.out_folder).label_counts()
+      self.write_metadata(label_counts, sum(writer.counts.values()), input_file=input_file, out_folder=out_folder)
+      if index is not None:
+        index.finish()
+      if stats:
+        self.report_models()
+        self.instrumentation.summary(out_folder + "/stats-summary.json")
+      print("Done!")
@@ -0,0 +1,160 @@
+import json
+import time
+from datetime import datetime
+from collections import Counter
+from contextlib import contextmanager
+
+def format_seconds(seconds):
+    # h:mm:ss
+    seconds = int(round(seconds))
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+class Instrumentation(object):
+    """
+    Per-stage timers, counters, cache hit rates and queue depths of an errorification run.
+    progress() prints the progress and, if snapshot_file is set, appends a JSON snapshot to it at most every interval seconds;
+    summary() returns (and optionally saves) the totals of the whole run.
+    Worker processes send their counts with take() and the parent adds them up with merge().
+    """
+    def __init__(self, snapshot_file=None, interval=30):
+        self.snapshot_file = snapshot_file
+        self.interval = interval
+        self.timers = Counter() # stage -> seconds
+        self.calls = Counter() # stage -> number of timed calls
+        self.counters = Counter()
+        self.gauges = {} # name -> (last value, max value)
+        self.caches = {} # name -> function returning the (hits, misses) of a cache of this process
+        self.cache_counts = {} # name -> (hits, misses) merged from the workers
+        self.cache_taken = {} # name -> (hits, misses) already sent by take()
+        self.start()
+
+    def start(self, total=None, done=0):
+        """ Starts the clock. done is the number of items processed before, e.g. restored from a checkpoint """
+        self.t0 = time.time()
+        self.last_snapshot = self.t0
+        self.total = total
+        self.done = done
+        self.start_done = done
+        if self.snapshot_file is not None and not done:
+            open(self.snapshot_file, 'w').close() # a new run starts a new file, a resumed one appends to it
+
+    def add_time(self, stage, seconds, calls=1):
+        self.timers[stage] += seconds
+        self.calls[stage] += calls
+
+    @contextmanager
+    def timer(self, stage):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - t)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def gauge(self, name, value):
+        last, peak = self.gauges.get(name, (value, value))
+        self.gauges[name] = (value, max(peak, value))
+
+    def watch_cache(self, name, stats):
+        self.caches[name] = stats
+
+    def cache_rates(self):
+        counts = dict(self.cache_counts)
+        for name, stats in self.caches.items():
+            hits, misses = stats()
+            merged_hits, merged_misses = counts.get(name, (0, 0))
+            counts[name] = (merged_hits + hits, merged_misses + misses)
+        return {name: {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+                for name, (hits, misses) in counts.items()}
+
+    def take(self):
+        """ The counts since the last take(), to be merged into the instrumentation of the parent process """
+        state = {"timers": dict(self.timers), "calls": dict(self.calls), "counters": dict(self.counters),
+                 "gauges": dict(self.gauges), "caches": {}}
+        for name, stats in self.caches.items():
+            hits, misses = stats()
+            taken_hits, taken_misses = self.cache_taken.get(name, (0, 0))
+            state["caches"][name] = (hits - taken_hits, misses - taken_misses)
+            self.cache_taken[name] = (hits, misses)
+        self.timers.clear()
+        self.calls.clear()
+        self.counters.clear()
+        self.gauges.clear()
+        return state
+
+    def merge(self, state):
+        self.timers.update(state["timers"])
+        self.calls.update(state["calls"])
+        self.counters.update(state["counters"])
+        for name, (last, peak) in state["gauges"].items():
+            merged_peak = self.gauges.get(name, (last, peak))[1]
+            self.gauges[name] = (last, max(peak, merged_peak))
+        for name, (hits, misses) in state["caches"].items():
+            merged_hits, merged_misses = self.cache_counts.get(name, (0, 0))
+            self.cache_counts[name] = (merged_hits + hits, merged_misses + misses)
+
+    def __getstate__(self):
+        # the watched caches belong to the process that registered them
+        state = dict(self.__dict__)
+        state["caches"] = {}
+        return state
+
+    def snapshot(self):
+        elapsed = time.time() - self.t0
+        done = self.done - self.start_done # processed by this run
+        rate = done / elapsed if elapsed > 0 else None
+        eta = None
+        if self.total is not None and rate:
+            eta = max(self.total - self.done, 0) / rate
+        timed = sum(self.timers.values())
+        return {
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "elapsed": elapsed,
+            "processed": self.done,
+            "total": self.total,
+            "per_second": rate,
+            "eta": eta,
+            "stages": {stage: {"seconds": seconds, "calls": self.calls[stage], "share": seconds / timed if timed else 0.0}
+                       for stage, seconds in self.timers.most_common()},
+            "counters": dict(self.counters),
+            "caches": self.cache_rates(),
+            "queues": {name: {"last": last, "max": peak} for name, (last, peak) in self.gauges.items()},
+        }
+
+    def describe(self, snapshot):
+        message = f"{snapshot['processed']} sentences were processed in {format_seconds(snapshot['elapsed'])}"
+        if snapshot["per_second"]:
+            message += f" ({snapshot['per_second']:.1f} sentences/s)"
+        if snapshot["eta"] is not None:
+            message += f"\nProjected time till the end: {format_seconds(snapshot['eta'])}"
+        return message
+
+    def progress(self, done, force=False):
+        """ Records that done items are processed in total; reports at most every interval seconds unless forced """
+        self.done = done
+        now = time.time()
+        if not force and now - self.last_snapshot < self.interval:
+            return
+        self.last_snapshot = now
+        snapshot = self.snapshot()
+        if self.snapshot_file is not None:
+            with open(self.snapshot_file, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
+        print(self.describe(snapshot))
+
+    def summary(self, summary_file=None):
+        """ The totals of the run, printed stage by stage and saved to summary_file as JSON if given """
+        summary = self.snapshot()
+        print(f"Stage timings ({format_seconds(summary['elapsed'])} in total):")
+        for stage, timing in summary["stages"].items():
+            print(f"  {stage}: {timing['seconds']:.1f} s ({timing['share']:.0%})")
+        for name, value in summary["counters"].items():
+            print(f"  {name}: {value}")
+        for name, rates in summary["caches"].items():
+            print(f"  {name} cache hit rate: {rates['hit_rate']:.1%}")
+        if summary_file is not None:
+            with open(summary_file, 'w') as f:
+                json.dump(summary, f, indent=2)
+        return summary
@@ -1,16 +1,54 @@
 import random
 import os
+from itertools import islice
+import numpy as np
+from StreamHandler import StreamHandler
 
 class InversionErrorifier(object):
     """
     Makes inversion errors in data.
+    The corpus is errorified chunk by chunk: the swaps of a whole chunk (word positions and window offsets)
+    are drawn in one go from a generator seeded with the seed and the chunk id. When the words are separated by single
+    spaces, the swaps are applied to the UTF-16 code units of the whole chunk at once, without splitting the sentences;
+    otherwise only the swapped sentences are split and joined again. The window distribution is one of
+    - "uniform": every offset in [-window, window] but 0 is equally likely;
+    - "triangular": the closer the word, the likelier, with weights window, ..., 2, 1;
+    - "geometric": every next word away is half as likely;
+    - a dict {offset: weight} of custom offsets.
+    Every sentence gets `swaps` swaps, or, with swap_rate, a Poisson number of them with swap_rate swaps per word (at least one).
     """
-    def __init__(self):
-        pass
+    def __init__(self, window=2, distribution="uniform", swaps=1, swap_rate=None, seed=42, chunk_size=10000):
+        self.stream_handler = StreamHandler()
+        self.offsets, self.offset_p = self.window_distribution(window, distribution)
+        self.swaps = swaps
+        self.swap_rate = swap_rate
+        self.seed = seed
+        self.chunk_size = chunk_size
+
+    def window_distribution(self, window, distribution):
+        """ The offsets of the swapped word and their probabilities """
+        if isinstance(distribution, dict):
+            weights = {offset: weight for offset, weight in distribution.items() if weight > 0}
+            if not weights or 0 in weights:
+                raise ValueError("The custom distribution needs positive weights for non-zero offsets")
+        else:
+            if window < 1:
+                raise ValueError("The window must be at least 1")
+            distances = {"uniform": lambda d: 1.0,
+                         "triangular": lambda d: window - d + 1.0,
+                         "geometric": lambda d: 0.5 ** (d - 1)}
+            if distribution not in distances:
+                raise ValueError(f"Unknown distribution {distribution}, expected one of {list(distances)} or a dict")
+            weights = {sign * d: distances[distribution](d) for d in range(1, window + 1) for sign in (-1, 1)}
+        offsets = np.array(sorted(weights), dtype=np.int64)
+        p = np.array([weights[offset] for offset in offsets], dtype=np.float64)
+        return offsets, p / p.sum()
 
     def switch_words(self, sentence):
         words = sentence.split()
         n = len(words)
+        if not n: # nothing to switch in an empty line
+            return sentence
         random_word_index = random.randint(0, n-1)
         for i in range(max(0, random_word_index - 2), min(n-1, random_word_index + 3)):
             if i != random_word_index:
@@ -18,27 +56,130 @@ class InversionErrorifier(object):
                 break
         return ' '.join(words)
 
-    def main(self, input_file, out_folder):
+    def chunk_words(self, sentences):
+        """
+        The chunk as one array of UTF-16 code units (the sentences joined by newlines), the start and the end of every word
+        in it and the number of words of every sentence; None if a sentence is not made of words separated by single spaces,
+        where the words would not be the ones split() gives.
+        """
+        # printable: the space is the only whitespace in the sentences
+        if not ''.join(sentences).isprintable():
+            return None
+        units = np.frombuffer('\n'.join(sentences).encode('utf-16-le'), dtype=np.uint16)
+        # every space or newline ends a word, an empty sentence being one empty word
+        delimiters = np.flatnonzero((units == ord(' ')) | (units == ord('\n'))).astype(np.int32) # the positions fit, halving the index arrays
+        space = units[delimiters] == ord(' ')
+        # no space next to another space or a newline, nor at the ends of the chunk
+        adjacent = np.flatnonzero(np.diff(delimiters) == 1)
+        if len(units) and (units[0] == ord(' ') or units[-1] == ord(' ') or (space[adjacent] | space[adjacent + 1]).any()):
+            return None
+        starts = np.concatenate((np.zeros(1, dtype=np.int32), delimiters + 1))
+        ends = np.concatenate((delimiters, np.full(1, len(units), dtype=np.int32)))
+        first_words = np.concatenate(([0], np.flatnonzero(~space) + 1))
+        lengths = np.diff(np.concatenate((first_words, [len(starts)])))
+        lengths[ends[first_words] == starts[first_words]] = 0
+        return units, starts, ends, first_words, lengths
+
+    def swap_units(self, units, starts, ends, order):
+        """ The sentences with the word order[k] put in the place of the k-th word of the chunk, the spaces and newlines kept """
+        sizes = ends - starts
+        new_sizes = sizes[order]
+        # a word lands shifted by how much longer the words before it in its sentence became; the shift is back to 0
+        # at the end of every sentence, so only the words of the swapped spans are copied
+        shifts = np.concatenate(([0], np.cumsum(new_sizes - sizes)[:-1]))
+        slots = np.flatnonzero((order != np.arange(len(order))) | (shifts != 0))
+        targets = starts[slots] + shifts[slots]
+        sources = starts[order[slots]]
+        lengths = new_sizes[slots]
+        # the position of every code unit of the copied words, and how far it moves
+        source_units = np.repeat(sources - (np.cumsum(lengths) - lengths), lengths)
+        source_units += np.arange(len(source_units), dtype=source_units.dtype)
+        out = units.copy()
+        out[source_units + np.repeat(targets - sources, lengths)] = units[source_units]
+        # the words inside a sentence are followed by a space, wherever they moved
+        inside = units[np.minimum(ends[slots], len(units) - 1)] == ord(' ')
+        out[(targets + lengths)[inside]] = ord(' ')
+        return out.tobytes().decode('utf-16-le').split('\n')
+
+    def draw_swaps(self, lengths, rng):
+        """ For sentences of the given lengths: the number of swaps of every sentence, and the word pairs to swap """
+        if self.swap_rate is None:
+            counts = np.where(lengths > 1, self.swaps, 0)
+        else:
+            counts = np.where(lengths > 1, np.maximum(1, rng.poisson(self.swap_rate * lengths)), 0)
+        n = np.repeat(lengths, counts) # the length of the sentence of every swap
+        positions = (rng.random(len(n)) * n).astype(np.int64)
+        targets = positions + rng.choice(self.offsets, size=len(n), p=self.offset_p)
+        # an offset falling out of the sentence is mirrored into it, then clipped if the sentence is too short for it
+        outside = (targets < 0) | (targets >= n)
+        targets[outside] = 2 * positions[outside] - targets[outside]
+        targets = np.clip(targets, 0, n - 1)
+        # a word is never swapped with itself
+        same = targets == positions
+        targets[same] = np.where(positions[same] + 1 < n[same], positions[same] + 1, positions[same] - 1)
+        return counts, positions, targets
+
+    def invert_chunk(self, sentences, chunk_id=0, seed=None):
+        """ The errorified sentences of a chunk; depends only on the sentences, the seed (self.seed by default) and the chunk id """
+        rng = np.random.default_rng([self.seed if seed is None else seed, chunk_id])
+        words = self.chunk_words(sentences) if sentences else None
+        if words is None:
+            return self.invert_split(sentences, rng)
+        units, starts, ends, first_words, lengths = words
+        counts, positions, targets = self.draw_swaps(lengths, rng)
+        if not len(positions):
+            return list(sentences)
+
+        # the swaps move the words of the whole chunk at once, the k-th swaps of all the sentences in one step
+        first = np.repeat(first_words, counts)
+        a, b = first + positions, first + targets
+        rounds = np.arange(len(a)) - np.repeat(np.cumsum(counts) - counts, counts)
+        order = np.arange(len(starts))
+        for k in range(int(counts.max())):
+            x, y = a[rounds == k], b[rounds == k]
+            order[x], order[y] = order[y], order[x].copy()
+        return self.swap_units(units, starts, ends, order)
+
+    def invert_split(self, sentences, rng):
+        # for irregular spacing: the sentences are split, the swaps are taken off one flat iterator in order,
+        # and only the swapped sentences are joined again
+        words = [sentence.split() for sentence in sentences]
+        counts, positions, targets = self.draw_swaps(np.fromiter(map(len, words), dtype=np.int64, count=len(words)), rng)
+        out_sentences = list(sentences)
+        swaps = zip(positions.tolist(), targets.tolist())
+        swapped = np.flatnonzero(counts)
+        for i, count in zip(swapped.tolist(), counts[swapped].tolist()):
+            sentence_words = words[i]
+            for a, b in islice(swaps, count):
+                sentence_words[a], sentence_words[b] = sentence_words[b], sentence_words[a]
+            out_sentences[i] = ' '.join(sentence_words)
+        return out_sentences
+
+    def write_pairs(self, lines, out_folder):
+        # writing the source and the target chunk by chunk
+        with open(out_folder + "/source.txt", 'w') as source, open(out_folder + "/target.txt", 'w') as target:
+            for chunk_id, chunk in enumerate(self.stream_handler.chunked(lines, self.chunk_size)):
+                prefix = '\n' if chunk_id else ''
+                source.write(prefix + '\n'.join(self.invert_chunk(chunk, chunk_id)))
+                target.write(prefix + '\n'.join(chunk))
+
+    def main(self, input_file, out_folder, stream=False):
         # creating the output folder
         if not os.path.exists(out_folder):
             os.mkdir(out_folder)
 
+        if stream:
+            return self.main_stream(input_file, out_folder)
+
         # reading the file
         with open(input_file, 'r') as f:
             text = f.read()
             lines = text.split('\n')
 
-        out_sentences = []
-        for sentence in dataset:
-            errorified = self.switch_words(sentence)
-            out_sentences.append(errorified)
-
-        text = '\n'.join(out_sentences)
-        with open(out_folder + "/source.txt", 'w') as f:
-            f.writelines(text)
-
-        text = '\n'.join(dataset)
-        with open(out_folder + "/target.txt", 'w') as f:
-            f.write(text)
+        self.write_pairs(lines, out_folder)
+        print("Done!")
 
-        print("Done!")
\ No newline at end of file
+    def main_stream(self, input_file, out_folder):
+        # the corpus is read lazily, so the memory does not grow with it
+        self.write_pairs(self.stream_handler.read_lines(input_file), out_folder)
+        print("Done!")
@@ -0,0 +1,157 @@
+import os
+import gc
+import time
+import importlib
+import multiprocessing
+
+class LazyModule(object):
+    """
+    A heavy module, or an attribute of it such as a class, imported on first use.
+    It is kept as a module global in place of the import, so it can be swapped for a stand-in like the module itself.
+    """
+    def __init__(self, name, attribute=None):
+        self._lazy_name = name
+        self._lazy_attribute = attribute
+        self._lazy_target = None
+
+    def _resolve(self):
+        if self._lazy_target is None:
+            target = importlib.import_module(self._lazy_name)
+            if self._lazy_attribute is not None:
+                target = getattr(target, self._lazy_attribute)
+            self._lazy_target = target
+        return self._lazy_target
+
+    def __getattr__(self, key):
+        # only called for the attributes of the module; the private ones may be missing while unpickling
+        if key.startswith("_lazy") or key.startswith("__"):
+            raise AttributeError(key)
+        return getattr(self._resolve(), key)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+def current_rss_mb():
+    # the resident memory of this process now, None where /proc is not available
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+def process_memory():
+    """ The resident memory of this process split into shared (e.g. copy-on-write pages of a forked parent) and private pages, in MB """
+    fields = {}
+    try:
+        with open("/proc/self/smaps_rollup", 'r') as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                if value.strip().endswith("kB"):
+                    fields[key] = int(value.split()[0]) / 1024
+    except (OSError, ValueError):
+        return {"rss_mb": current_rss_mb()}
+    return {"rss_mb": fields.get("Rss"),
+            "shared_mb": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+            "private_mb": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)}
+
+class ModelRegistry(object):
+    """
+    Process-wide models and other heavy objects, loaded once on first use and shared by all the errorifiers.
+    A model is registered under a name saying what it is (e.g. "pymorphy2:uk") with a loader taking the registry,
+    so loaders can build on other models; the first get() loads it, so building an errorifier loads nothing.
+    preload() loads models in a parent process before it forks its workers, which then share the pages copy-on-write.
+    The resident memory taken by every model (without the models it loaded itself) is kept in memory.
+    """
+    def __init__(self):
+        self.loaders = {}
+        self.models = {}
+        self.memory = {} # name -> {"rss_mb": ..., "seconds": ...}
+        self.loading = [] # the rss taken by the models loaded by the models being loaded
+
+    def register(self, name, loader):
+        self.loaders[name] = loader
+
+    def get(self, name):
+        if name not in self.models:
+            if name not in self.loaders:
+                raise KeyError(f"No model {name} is registered")
+            rss, t = current_rss_mb(), time.time()
+            self.loading.append(0.0)
+            try:
+                model = self.loaders[name](self)
+            finally:
+                nested = self.loading.pop()
+            taken = None if rss is None else current_rss_mb() - rss
+            if taken is not None and self.loading:
+                self.loading[-1] += taken
+            self.memory[name] = {"rss_mb": None if taken is None else taken - nested, "seconds": time.time() - t}
+            self.models[name] = model
+        return self.models[name]
+
+    def loaded(self, name):
+        return name in self.models
+
+    def load(self, names=None):
+        """ Loads the given models, all the registered ones by default """
+        for name in (list(self.loaders) if names is None else names):
+            self.get(name)
+        return self
+
+    def preload(self, names=None, freeze=True):
+        """
+        Loads the models before forking. With freeze, the objects alive so far are moved out of reach of the
+        garbage collector, whose passes would otherwise write to their pages and unshare them in the workers;
+        the garbage is collected first, so it is not kept for good. Call unfreeze() once the workers are done.
+        """
+        self.load(names)
+        if freeze and hasattr(gc, "freeze"):
+            gc.collect()
+            gc.freeze()
+        return self
+
+    def unfreeze(self):
+        """ Hands the objects frozen by preload() back to the garbage collector """
+        if hasattr(gc, "unfreeze"):
+            gc.unfreeze()
+
+    def memory_report(self):
+        """ Prints and returns the resident memory taken by every loaded model """
+        for name, usage in self.memory.items():
+            rss = "unknown" if usage["rss_mb"] is None else f"{usage['rss_mb']:.1f} MB"
+            print(f"  {name}: {rss}, loaded in {usage['seconds']:.1f} s")
+        return dict(self.memory)
+
+def fork_context():
+    """ The fork start method where the platform has it, so that the workers share the preloaded models; else the default """
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return None
+
+# the registry shared by the errorifiers of this process
+shared_models = ModelRegistry()
+
+def lazy_models(obj):
+    """ The registry names of the LazyModel attributes of an errorifier """
+    return [attribute.registry_name(obj) for cls in type(obj).__mro__ for attribute in vars(cls).values() if isinstance(attribute, LazyModel)]
+
+class LazyModel(object):
+    """
+    A class attribute standing for a model of the errorifier's registry (self.models), by its registry name,
+    or by a function of the errorifier returning the name when it depends on the settings.
+    The model is loaded on first access and then kept as a plain instance attribute, which can be reassigned.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __set_name__(self, owner, attribute):
+        self.attribute = attribute
+
+    def registry_name(self, obj):
+        return self.name(obj) if callable(self.name) else self.name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = obj.models.get(self.registry_name(obj))
+        obj.__dict__[self.attribute] = value
+        return value
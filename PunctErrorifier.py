@@ -3,21 +3,156 @@ import os
 import json
 import time
 import sys
-import pandas as pd
 import numpy as np
 from datetime import datetime
-from sklearn.model_selection import train_test_split
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from helpers.classes.SpaceHandler import SpaceHandler
+from StreamHandler import StreamHandler
+from Instrumentation import Instrumentation
+from ColumnarDataset import ColumnarDataset
+
+# the errorifier of a worker process, set once by the pool initializer
+_worker_errorifier = None
+
+def _init_punct_worker(errorifier):
+    global _worker_errorifier
+    _worker_errorifier = errorifier
+    _worker_errorifier.instrumentation = Instrumentation() # the counts of the parent are not the worker's
+
+def _errorify_punct_shard(shard):
+    # the shard and the timings and counters it took
+    return _worker_errorifier.errorify_shard(*shard), _worker_errorifier.instrumentation.take()
+
+class MarkSampler(object):
+    """
+    Draws incorrect marks from a compiled transfer matrix.
+    Every row is stored as a cumulative distribution, so a draw is a single searchsorted.
+    """
+    def __init__(self, transfer_matrix):
+        self.marks = list(transfer_matrix.columns)
+        self.mark_to_row = {mark: i for i, mark in enumerate(transfer_matrix.index)}
+        self.cdf = np.cumsum(transfer_matrix.to_numpy(dtype=np.float64), axis=1)
+        self.last = len(self.marks) - 1
+
+    def sample(self, correct_mark, rng=np.random):
+        # same draw as walking the row until the cumulative sum reaches p
+        p = rng.random()
+        k = int(np.searchsorted(self.cdf[self.mark_to_row[correct_mark]], p, side='left'))
+        return self.marks[min(k, self.last)] # guarding against the rounding at the end of the row
+
+    def sample_many(self, correct_marks, rng=np.random):
+        """
+        Samples all the given punctuation slots (a sentence or a whole chunk) in one vectorized call.
+        Consumes the random stream exactly like the same number of sample() calls.
+        rng is either the global np.random or a seeded np.random.Generator.
+        """
+        if not len(correct_marks):
+            return []
+        rows = self.cdf[[self.mark_to_row[m] for m in correct_marks]]
+        p = rng.random(len(correct_marks))
+        # counting the cumulative probabilities below p is searchsorted applied row by row
+        ks = np.minimum((rows < p[:, None]).sum(axis=1), self.last)
+        return [self.marks[k] for k in ks]
+
+class PunctTokenizer(object):
+    """
+    Compiled tokenizer and detokenizer of the punctuation errorifier.
+    The literal substitutions are plain string replaces, the spaces before the punctuation go in one
+    precompiled pass and the words and the punctuation between them are split out by the C regex engine;
+    the tokens and the interpreted sentences are the same as with the step by step regex version.
+
+    The tokenizer also tells if a sentence is plain: it only has single spaces and marks that fried_nails glues
+    to the previous word. The tags of a plain sentence interpret back to it by construction, unless
+    a mark fried_nails does not glue was deleted, so the anti_tagger check can be skipped for it.
+    Which marks are glued is probed on fried_nails itself.
+    """
+    marks = [',', ';', ':', chr(8212), '-', '.', '?', '!', chr(8230)]
+    restored = [(chr(8230), '...'), (' " ', '"'), (chr(512), '.,'), (chr(513), '.:'), (chr(514), '.;')]
+
+    def __init__(self, space_handler):
+        self.space_handler = space_handler
+        self.mark_set = set(self.marks)
+        self.word_re = re.compile(space_handler.uwr)
+        self.cling_re = re.compile(r"\s(?=[.,;:?!—-…])") # the spaces before the punctuation
+        # the symbols the detokenizer rewrites; a sentence with any of them is never plain
+        self.encoded_re = re.compile('[' + re.escape(''.join(set(''.join(key for key, value in self.restored)) - {' '})) + ']')
+        self.probe()
+
+    def probe(self):
+        fried_nails = self.space_handler.fried_nails
+        # the text must stay as it is, and the spaces left by the removed marks must be squeezed
+        self.fast = fried_nails("а б") == "а б" and fried_nails(" а  б ") == "а б" and self.word_re.groups == 0
+        # the ellipsis is written back as three dots, so it never interprets back to itself
+        self.glued = {mark for mark in self.marks if mark != chr(8230)
+                      and fried_nails(f"а {mark} б") == f"а{mark} б" and fried_nails(f"а{mark} б") == f"а{mark} б"
+                      and fried_nails(f"а {mark} ") == f"а{mark}"}
+        self.plain_pieces = {' '} | {mark + ' ' for mark in self.glued} # what can stand between two words
+        self.plain_ends = {''} | self.glued # and after the last one
+        self.unsafe_labels = {f"$APPEND_{mark}" for mark in self.marks if mark not in self.glued}
+
+    def scan(self, sentence):
+        """ The tokens of tokenize_sentence, and whether the sentence is plain """
+        # preparing the data: the ellipsis as one symbol, separated quotation marks,
+        # the punctuation clung to the words and the contractions encoded
+        text = self.space_handler.space_stripper(sentence).replace("...", chr(8230)).replace('"', ' " ')
+        text = self.cling_re.sub('', self.space_handler.space_stripper(text))
+        text = text.replace(".,", chr(512)).replace(".:", chr(513)).replace(".;", chr(514))
+
+        words = self.word_re.findall(text)
+        pieces = self.word_re.split(text)
+        if not words:
+            return ['$START', ' '], False
+        # the punctuation between the words is kept as its first symbol; the text before the first word is a space
+        tokens = ['$START', ' '] + [None] * (2 * len(words))
+        tokens[2::2] = words
+        tokens[3:-1:2] = [piece[0] for piece in pieces[1:-1]]
+        tokens[-1] = pieces[-1][0] if pieces[-1] else ' '
+
+        plain = (self.fast and text == sentence and not pieces[0] and pieces[-1] in self.plain_ends
+                 and self.plain_pieces.issuperset(pieces[1:-1]) and self.mark_set.isdisjoint(words)
+                 and self.encoded_re.search(text) is None)
+        return tokens, plain
+
+    def reversible(self, labels):
+        # only deleted marks that fried_nails does not glue back break a plain sentence
+        return self.unsafe_labels.isdisjoint(labels)
+
+    def interpret(self, token, label):
+        if label == '$DELETE': # if we delete the token
+            return ''
+        if 'APPEND_' in label: # if we need to append one
+            return token + label[-1]
+        if 'REPLACE_' in label: # and if we need to replace
+            return label[-1]
+        print("Unidentified tag")
+        return ''
+
+    def detokenize(self, tokens, labels):
+        """ Applies the tags and converts the tokens back into the sentence, like anti_tagger """
+        # interpreting the tags; most of them keep the token
+        parts = [token if label == '$KEEP' else self.interpret(token, label) for token, label in zip(tokens[1:], labels[1:])]
+        sentence = ' '.join(parts) + ' ' if parts else ''
+        if "APPEND_" in labels[0]: # if begins with append
+            sentence = labels[0][-1] + sentence
+        # fixing the special symbols
+        for encoded, symbol in self.restored:
+            sentence = sentence.replace(encoded, symbol)
+        return self.space_handler.fried_nails(sentence)
 
 class PunctErrorifier(object):
     """
     Makes tagged and human-readable punctuation errors in data.
     """
-    def __init__(self, space_handler=SpaceHandler()):
+    def __init__(self, space_handler=SpaceHandler(), stream_handler=StreamHandler(), fast_validation=True):
         self.space_handler = space_handler
-        self.transfer_matrix = pd.DataFrame()
+        self.stream_handler = stream_handler
+        self.tokenizer = PunctTokenizer(space_handler)
+        self.fast_validation = fast_validation # skipping the anti_tagger check where it cannot fail
+        self.transfer_matrix = None # a pandas DataFrame once generated
         self.marks = []
+        self.sampler = None
+        self.instrumentation = Instrumentation() # per-stage timers and counters
 
     def generate_transfer_matrix(self):
         """ For simplicity, we create the transfer matrix between marks.
@@ -25,6 +160,7 @@ class PunctErrorifier(object):
         as _ -- also the punctuation mark, like the empty set.
         transfer_matrix[',',';'] is the probability of comma to be converted to semicolon
         """
+        import pandas as pd # imported here, so that building the errorifier stays cheap
         self.marks = [' ', ',', ';', ':', chr(8212), '-', '.', '?', '!', chr(8230)] # Encoded punctuation marks
 
         transfer_matrix = pd.DataFrame(data = np.zeros((len(self.marks), len(self.marks))),
@@ -114,6 +250,8 @@ class PunctErrorifier(object):
         update_cell(transfer_matrix, ':', ',', 0.05) #to increase number of replace_:
         # generate the actual error matrix
         self.transfer_matrix = transfer_matrix
+        # compiling it once for sampling
+        self.sampler = MarkSampler(transfer_matrix)
         return
     
     def tokenize_sentence(self, sentence):
@@ -121,61 +259,34 @@ class PunctErrorifier(object):
         Creates a list of tokens, where each space between words is a separate token
         Example: ["START", "", "Я", "", "вісім", "", "років", "", "бомбив", "", "Донбас", "," "вбив", "", "багатьох", ":", "дітей" "," "дорослих" "," "і", "", "стариків", "."]
         """
-        # preparing the data
-        # getting rid of extra spaces
-        sentence = self.space_handler.space_stripper(sentence)
-        # replacing the ellipsis with one symbol
-        sentence = re.sub("\.\.\.", chr(8230), sentence)
-        # separating the quotation marks
-        sentence = re.sub('"', ' " ', sentence)
-        # clinging the punctuation back to those fuckers
-        sentence = re.sub(r"\s([.,;:?!—-…])", r"\1", self.space_handler.space_stripper(sentence)) 
-        # fixing the contractions (ЭТО КОСТЫЛЬ, НУЖНО ЗАМЕНИТЬ В БЛИЖАЙШЕЕ ВРЕМЯ)
-        sentence = re.sub(r'\.,', chr(512), sentence)
-        sentence = re.sub(r'\.:', chr(513), sentence)
-        sentence = re.sub(r'\.;', chr(514), sentence)
-        # matching the words
-        words = re.findall(self.space_handler.uwr, sentence)
-
-        # matching the punctuation
-        punctuation = re.split(self.space_handler.uwr, sentence)
-
-        # adding it as empty/non-empty tokens
-        # fixing edge cases for our beloved quotation marks
-        punctuation[0] = ' '
-        if punctuation[-1] == '':
-            punctuation[-1] = ' '
-
-        punctuation = [list(p)[0] for p in punctuation]
-        tokens = ['$START']
-        for i in range(len(words)):
-            # adding everything to the token list
-            tokens.append(punctuation[i])
-            tokens.append(words[i])
-        tokens.append(punctuation[-1])
-        return tokens
+        # one compiled scan (see PunctTokenizer)
+        return self.tokenizer.scan(sentence)[0]
 
     # generating the error
-    def generate_the_error(self, correct_mark):
-        p = np.random.random()
-        k = 0
-        while p > self.transfer_matrix.iloc[self.marks.index(correct_mark),:k+1].sum(): # this is to choose the option with the given discrete distribution
-            k += 1
-        incorrect_mark = self.marks[k]
+    def generate_the_error(self, correct_mark, rng=np.random):
+        incorrect_mark = self.sampler.sample(correct_mark, rng) # this is to choose the option with the given discrete distribution
         return incorrect_mark
 
-    def errorify_and_tag(self, sentence):
-        # tokenizing the sentence
-        tokens = self.tokenize_sentence(sentence)
+    def errorify_and_tag(self, sentence, rng=np.random, tokens=None):
+        t0 = time.perf_counter()
+        # tokenizing the sentence, unless it is already tokenized
+        if tokens is None:
+            tokens = self.tokenize_sentence(sentence)
+            self.instrumentation.add_time("tokenize", time.perf_counter() - t0)
+        t1 = time.perf_counter()
         # creating a list of labels of the same length
         labels = ['' for i in range(len(tokens))]
-        
+        # sampling every punctuation slot of the sentence at once
+        slots = [i for i in range(len(tokens)) if tokens[i] in self.sampler.mark_to_row]
+        imarks = dict(zip(slots, self.sampler.sample_many([tokens[i] for i in slots], rng)))
+        t2 = time.perf_counter()
+
         # traversing through the list and generating errors for spaces between words
         for i in range(len(tokens)):
             # if it is a space, then the only option is to (de)generate a erroneous mark
             # so, the model needs to delete it
             if tokens[i] == ' ':
-                imark = self.generate_the_error(' ')
+                imark = imarks[i]
                 if imark != ' ': # if changed
                     labels[i] = "$DELETE" # place the label
                     tokens[i] = imark # put the incorrect mark in tokens instead of a space
@@ -185,7 +296,7 @@ class PunctErrorifier(object):
             # if it is a punctuation mark, then there are a few options which we might pick
             elif tokens[i] in self.marks:
                 cmark = tokens[i] # retrieve the punctuation symbol
-                imark = self.generate_the_error(cmark) # generate an error
+                imark = imarks[i] # generate an error
 
                 if imark == ' ': # means that we have deleted cmark and need to put it back. thus we need to connect append to the previous word or the punctuation mark
                     labels[i-1] = f"$APPEND_{cmark}"
@@ -205,6 +316,8 @@ class PunctErrorifier(object):
             if len(tokens) != len(labels):
                 print("Token list and label list do not match in length before space removal!")
             assert(len(tokens) == len(labels))    
+        self.instrumentation.add_time("sample", t2 - t1)
+        self.instrumentation.add_time("tag", time.perf_counter() - t2)
         return tokens, labels
 
     # removing the spaces (as in пробел) between words
@@ -224,90 +337,141 @@ class PunctErrorifier(object):
 
     # applying tags and converting back into the original sentence
     def anti_tagger(self, tokens, labels):
-        # empty sentence to be filled
-        sentence = ''
-        # interpreting the tags
-        if "APPEND_" in labels[0]: # if begins with append
-            sentence += labels[0][-1]
-        for i in range(1, len(tokens)):
-            if labels[i] == '$KEEP': # if nothing changes
-                sentence += tokens[i]
-            elif labels[i] == '$DELETE': # if we delete the token
-                sentence += '' # pass
-            elif 'APPEND_' in labels[i]: # if we need to append one
-                sentence += tokens[i] + labels[i][-1]
-            elif 'REPLACE_' in labels[i]: # and if we need to replace
-                sentence += labels[i][-1]
-            else:
-                print("Unidentified tag")
-            sentence += ' '
-        # fixing the special symbols
-        sentence = re.sub(chr(8230), '...', sentence)
-        # returning
-        sentence = re.sub(' " ', '"', sentence)
-        sentence = re.sub(chr(512), '.,', sentence)
-        sentence = re.sub(chr(513), '.:', sentence)
-        sentence = re.sub(chr(514), '.;', sentence)
-        return self.space_handler.fried_nails(sentence)
+        return self.tokenizer.detokenize(tokens, labels)
 
     # amalgaming all those functions together
-    def new_errorifier_tagger(self, sentence):
+    def new_errorifier_tagger(self, sentence, rng=np.random, tokens=None):
         # doing the actual work
-        tokens, labels = self.errorify_and_tag(sentence)
-        tokens, labels = self.remove_space_tokens(tokens, labels)
+        tokens, labels = self.errorify_and_tag(sentence, rng, tokens)
+        with self.instrumentation.timer("tag"):
+            tokens, labels = self.remove_space_tokens(tokens, labels)
         return tokens, labels
 
-    def generate_final_list(self, lines):
-        np.random.seed(42) # for reproducibility
+    # errorifying a single line; returns None if the tags cannot be interpreted back
+    def errorify_line(self, l, rng=np.random):
+        # making sure that the sentence is clean and ready to be preprocessed
+        with self.instrumentation.timer("clean"):
+            correct_sentence = self.space_handler.fried_nails(l)
+        # tokenizing it, finding out if it is plain on the way
+        t0 = time.perf_counter()
+        tokens, plain = self.tokenizer.scan(correct_sentence)
+        self.instrumentation.add_time("tokenize", time.perf_counter() - t0)
+        # making the error
+        incorrect_sentence = self.new_errorifier_tagger(correct_sentence, rng, tokens)
+        # the tags of a plain sentence interpret back to it unless an unglued mark was deleted
+        if self.fast_validation and plain and self.tokenizer.reversible(incorrect_sentence[1]):
+            self.instrumentation.count("validation_skipped")
+            return incorrect_sentence
+        # making sure that the interpreted sentence is the original one
+        with self.instrumentation.timer("validate"):
+            interpreted = self.anti_tagger(incorrect_sentence[0], incorrect_sentence[1])
+        if interpreted == correct_sentence:
+            return incorrect_sentence
+        self.instrumentation.count("anti_tagger_mismatches")
+        return None
+
+    def errorify_shard(self, shard_id, lines, seed=42):
+        """
+        Errorifies one shard with its own generator derived from the master seed and the shard id,
+        so the result does not depend on which process picks the shard up.
+        Returns (source line, errorified sentence) pairs, the line being the key of the train/dev split.
+        """
+        rng = np.random.default_rng([seed, shard_id])
+        shard_list = []
+        for l in lines:
+            incorrect_sentence = self.errorify_line(l, rng)
+            if incorrect_sentence is not None:
+                shard_list.append((l, incorrect_sentence))
+        return shard_list
+
+    def generate_final_list(self, lines, workers=None, seed=42, shard_size=10000):
+        """
+        With workers=None the whole input is processed on one core with the global seed.
+        With workers=N the input is cut into shards of shard_size lines which are errorified on N processes;
+        the output is the same for any N.
+        """
+        if workers is not None:
+            return self.generate_final_list_sharded(lines, workers, seed, shard_size)
+
+        np.random.seed(seed) # for reproducibility
         final_list = []
-        t0 = time.time()
+        self.instrumentation.start(total=len(lines))
 
         print("Original length: " + str(len(lines)) + " sentences")
 
         # traversing through the list
         for i in range(len(lines)):
-            l = lines[i]
-            # making sure that the sentence is clean and ready to be preprocessed
-            correct_sentence = self.space_handler.fried_nails(l)
-            # making the error
-            incorrect_sentence = self.new_errorifier_tagger(correct_sentence)
+            incorrect_sentence = self.errorify_line(lines[i])
             # adding the sentence to the list
-            # making sure that the interpreted sentence is the original one
-            if self.anti_tagger(incorrect_sentence[0], incorrect_sentence[1]) == correct_sentence:
+            if incorrect_sentence is not None:
                 final_list.append(incorrect_sentence)
-            # else:
-            #   print(l)
-            # estimating the time left
-            i += 1
-            if not i % 10000:
-                print(f"{(time.time() - t0)/60:.1} mins elapsed so far. {i} sentences were processed\nProjected time till the end: {(time.time() - t0)/3600/i*(len(lines)-i):.2} hours")
+            # reporting the progress and the time left
+            self.instrumentation.progress(i + 1)
+        self.instrumentation.progress(len(lines), force=True)
+
+        print("Errorified length: " + str(len(final_list)) + " sentences")
+        return final_list
+
+    def generate_final_list_sharded(self, lines, workers, seed=42, shard_size=10000):
+        final_list = []
+        self.instrumentation.start(total=len(lines))
+
+        print("Original length: " + str(len(lines)) + " sentences")
+
+        # the shards are fixed by the input, not by the number of workers
+        shards = [(shard_id, lines[start:start + shard_size], seed)
+                  for shard_id, start in enumerate(range(0, len(lines), shard_size))]
+
+        if workers <= 1:
+            results = ((self.errorify_shard(*shard), None) for shard in shards)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_punct_worker, initargs=(self,))
+            results = executor.map(_errorify_punct_shard, shards) # map keeps the input order
+
+        try:
+            processed = 0
+            for shard, (shard_list, counts) in zip(shards, results):
+                if counts is not None: # timed in a worker
+                    self.instrumentation.merge(counts)
+                final_list.extend(sentence for line, sentence in shard_list)
+                processed += len(shard[1])
+                self.instrumentation.progress(processed)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.instrumentation.progress(processed, force=True)
 
         print("Errorified length: " + str(len(final_list)) + " sentences")
         return final_list
 
+    def human_readable_sentence(self, sentence):
+        # concatenating the list into a single errorified sentence
+        new_sentence = self.space_handler.fried_nails(' '.join([sentence[0][i] + ' ' for i in range(len(sentence[0]))])[len("$START"):])
+        # showing the tag-token alignment in a human-readable format
+        tagged_sentence = ' '.join(sentence[0][i] + sentence[1][i] + ' ' for i in range(len(sentence[0])))
+        # Interpreting the sentence
+        interpreted_sentence = self.anti_tagger(sentence[0], sentence[1])
+        return new_sentence + '\n' + tagged_sentence + '\n' + interpreted_sentence + '\n'
+
     def make_human_readable(self, final_list, out_folder):
         # making the human-readable version of the data
         with open(out_folder + "/human-readable.txt", 'w') as f:
             # traversing through the list
             for sentence in final_list:
-                # concatenating the list into a single errorified sentence
-                new_sentence = self.space_handler.fried_nails(' '.join([sentence[0][i] + ' ' for i in range(len(sentence[0]))])[len("$START"):])
-                # showing the tag-token alignment in a human-readable format
-                tagged_sentence = ' '.join(sentence[0][i] + sentence[1][i] + ' ' for i in range(len(sentence[0])))
-                # Interpreting the sentence
-                interpreted_sentence = self.anti_tagger(tagged_sentence[0], tagged_sentence[1])
                 # writing the sentences to the file
-                f.write(new_sentence + '\n' + tagged_sentence + '\n' + interpreted_sentence + '\n')
+                f.write(self.human_readable_sentence(sentence))
         print("Human-readable sentences have been generated!")
 
-    def generate_metadata(self, final_list, output_folder):
+    def generate_metadata(self, final_list, output_folder, input_file):
         "LABEL COUNTER"
-        all_labels = []
+        label_counts = Counter()
         for sent in final_list:
-            for label in sent[1]:
-                all_labels.append(label)
+            label_counts.update(sent[1])
+        self.write_metadata(label_counts, len(final_list), input_file=input_file, out_folder=output_folder)
+
+    def write_metadata(self, label_counts, n_sentences, *, input_file, out_folder):
         # count each label type
-        label_counts = dict(Counter(all_labels).items())
         label_counts = dict(sorted(label_counts.items(), key=lambda item: item[1], reverse=True))
         # saving the metadata
         message = "########## Preprocess info ##########\n"
@@ -320,10 +484,10 @@ class PunctErrorifier(object):
         message += f"Sample used: {input_file}\n"
 
         # writing the sentences size
-        message += f"Number of sentences : {len(final_list)}\n"
+        message += f"Number of sentences : {n_sentences}\n"
 
         # writing the tokens size
-        message += f"Number of tokens/tags : {len(all_labels)}\n"
+        message += f"Number of tokens/tags : {sum(label_counts.values())}\n"
 
         # writing the label vocab size
         message += f"Number of unique labels : {len(label_counts)}\n"
@@ -338,10 +502,18 @@ class PunctErrorifier(object):
         with open(out_folder + '/metadata.txt', 'w') as final_file:
             final_file.write(message)
 
-    def main(self, input_file, output_folder):
+    def main(self, input_file, output_folder, workers=None, stream=False, stats=False, columnar=False):
         """
         Driver function for generating the errors.
+        workers=N errorifies the input on N processes with per-shard seeding.
+        stream=True reads the input lazily and writes train.jsonl/dev.jsonl as the sentences are errorified.
+        stats=True writes periodic snapshots of the stage timings and counters to stats.jsonl and their totals to stats-summary.json.
+        columnar=True writes the train and dev sets as memory-mappable id arrays to output_folder/columnar (see ColumnarDataset)
+        instead of train.json/dev.json.
         """
+        if stream:
+            return self.main_stream(input_file, output_folder, workers, stats=stats, columnar=columnar)
+
         # reading the input data
         with open(input_file, 'r') as f:
             text = f.read()
@@ -352,20 +524,99 @@ class PunctErrorifier(object):
             os.mkdir(output_folder)
 
         self.generate_transfer_matrix()
+        if stats:
+            self.instrumentation.snapshot_file = output_folder + "/stats.jsonl"
         
         # generate the errors
-        final_list = self.generate_final_list(lines)
-
-        # splitting the dataset into train and dev
-        train, dev = train_test_split(final_list, test_size=0.2, random_state=47)
+        final_list = self.generate_final_list(lines, workers=workers)
+
+        with self.instrumentation.timer("write"):
+            # splitting the dataset into train and dev
+            from sklearn.model_selection import train_test_split # only the non-streaming split needs sklearn
+            train, dev = train_test_split(final_list, test_size=0.2, random_state=47)
+
+            if columnar:
+                # saving the train and the dev datasets as id arrays
+                with self.stream_handler.split_writer(output_folder, columnar=True) as writer:
+                    for split, records in (("train", train), ("dev", dev)):
+                        for record in records:
+                            writer.write_split(record, split)
+            else:
+                # saving the train and the dev datasets
+                with open(output_folder + "/train.json", 'w') as f:
+                    json.dump(train, f) 
 
-        # saving the train and the dev datasets
-        with open(output_folder + "/train.json", 'w') as f:
-            json.dump(train, f) 
+                with open(output_folder + "/dev.json", 'w') as f:
+                    json.dump(dev, f) 
 
-        with open(output_folder + "/dev.json", 'w') as f:
-            json.dump(dev, f) 
+            self.make_human_readable(final_list, output_folder)
+            if columnar:
+                # counting the labels on the label id arrays
+                self.write_metadata(ColumnarDataset(writer.out_folder).label_counts(), len(final_list), input_file=input_file, out_folder=output_folder)
+            else:
+                self.generate_metadata(final_list, output_folder, input_file)
+        if stats:
+            self.instrumentation.summary(output_folder + "/stats-summary.json")
+        print("Done!")
 
-        self.make_human_readable(final_list, output_folder)
-        self.generate_metadata(final_list, output_folder)
-        print("Done!")
\ No newline at end of file
+    def main_stream(self, input_file, output_folder, workers=None, seed=42, shard_size=10000, stats=False, columnar=False):
+        """
+        Streaming driver: memory stays constant in the size of the corpus.
+        Shards are seeded like in generate_final_list_sharded, so the records do not depend on the number of workers.
+        """
+        self.generate_transfer_matrix()
+        if not os.path.exists(output_folder):
+            os.mkdir(output_folder)
+        if stats:
+            self.instrumentation.snapshot_file = output_folder + "/stats.jsonl"
+        self.instrumentation.start()
+        # the number of input lines of every shard in flight, in order, since a result only holds the records kept
+        shard_lines = deque()
+        def read_shards():
+            for shard_id, lines in enumerate(self.stream_handler.chunked(self.stream_handler.read_lines(input_file), shard_size)):
+                shard_lines.append(len(lines))
+                yield shard_id, lines, seed
+        shards = read_shards()
+
+        executor = None
+        if workers is None or workers <= 1:
+            results = ((self.errorify_shard(*shard), None) for shard in shards)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_punct_worker, initargs=(self,))
+            results = self.stream_handler.ordered_map(executor, _errorify_punct_shard, shards, 2 * workers,
+                                                      depth=lambda n: self.instrumentation.gauge("pending_shards", n))
+
+        label_counts = Counter()
+        n_lines = 0
+        n_sentences = 0
+        try:
+            with self.stream_handler.split_writer(output_folder, columnar=columnar) as writer, \
+                 open(output_folder + "/human-readable.txt", 'w') as human_readable:
+                for shard_list, counts in results:
+                    if counts is not None: # timed in a worker
+                        self.instrumentation.merge(counts)
+                    with self.instrumentation.timer("write"):
+                        for line, sentence in shard_list:
+                            # keyed by the source line, so the split does not change with the errors drawn
+                            writer.write(sentence, key=line)
+                            human_readable.write(self.human_readable_sentence(sentence))
+                            if not columnar: # counted on the label id arrays instead
+                                label_counts.update(sentence[1])
+                    # the progress is in input lines, the records kept are counted on their own
+                    n_lines += shard_lines.popleft()
+                    n_sentences += len(shard_list)
+                    self.instrumentation.count("records_kept", len(shard_list))
+                    self.instrumentation.progress(n_lines)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.instrumentation.progress(n_lines, force=True)
+
+        print("Original length: " + str(n_lines) + " sentences")
+        print("Errorified length: " + str(n_sentences) + " sentences")
+        if columnar:
+            label_counts = ColumnarDataset(writer.out_folder).label_counts()
+        self.write_metadata(label_counts, n_sentences, input_file=input_file, out_folder=output_folder)
+        if stats:
+            self.instrumentation.summary(output_folder + "/stats-summary.json")
+        print("Done!")
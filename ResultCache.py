@@ -0,0 +1,80 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+
+def file_version(path):
+    """ The version of a model file: its path, size and modification time, so a replaced model gets new keys """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path
+    return f"{path}:{stat.st_size}:{int(stat.st_mtime)}"
+
+class ResultCache(object):
+    """
+    Content-addressed on-disk cache of the deterministic per-sentence results of an expensive stage, such as
+    parses and round-trip translations, so that runs over the same corpus with other hyperparameters only redo the sampling.
+    A result is keyed by the hash of the stage, the model/version and the sentence, and stored as JSON in SQLite;
+    several stages and processes can share one file. A connection is opened on first use in every process and thread,
+    so the cache can be created before the workers are forked and used by the pipeline threads.
+    """
+    def __init__(self, path, stage, version):
+        self.path = path
+        self.namespace = f"{stage}\0{version}\0"
+        self.connections = {} # (process, thread) -> connection
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        owner = (os.getpid(), threading.get_ident())
+        connection = self.connections.get(owner)
+        if connection is None:
+            connection = self.connections[owner] = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL") # the workers read while another one writes
+            connection.execute("CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID")
+            connection.commit()
+        return connection
+
+    def key(self, sentence):
+        return hashlib.blake2b((self.namespace + sentence).encode('utf-8'), digest_size=16).digest()
+
+    def get_many(self, sentences, batch_size=500):
+        """ Returns {sentence: result} for the sentences that are already cached """
+        keys = {self.key(sentence): sentence for sentence in set(sentences)}
+        found = {}
+        connection = self.connect()
+        key_list = list(keys)
+        # querying in batches to stay under the SQLite variable limit
+        for start in range(0, len(key_list), batch_size):
+            batch = key_list[start:start + batch_size]
+            query = "SELECT key, value FROM results WHERE key IN (%s)" % ", ".join("?" * len(batch))
+            for key, value in connection.execute(query, batch):
+                found[keys[key]] = json.loads(value)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, results):
+        """ Stores the {sentence: result} pairs """
+        connection = self.connect()
+        connection.executemany("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)",
+                               ((self.key(sentence), json.dumps(result, ensure_ascii=False)) for sentence, result in results.items()))
+        connection.commit()
+
+    def stats(self):
+        return self.hits, self.misses
+
+    def __getstate__(self):
+        # a connection cannot be pickled, the copy opens its own
+        state = dict(self.__dict__)
+        state["connections"] = {}
+        return state
+
+    def close(self):
+        # every connection is used by one thread only, but any thread of the process can close them
+        for owner, connection in list(self.connections.items()):
+            if owner[0] == os.getpid():
+                connection.close()
+                del self.connections[owner]
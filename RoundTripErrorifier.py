@@ -1,17 +1,160 @@
-import torch
 import os
+import copy
+import json
+import hashlib
 import time
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+import multiprocessing
+import queue
+import threading
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from StreamHandler import StreamHandler
+from Checkpointer import Checkpointer
+from SentenceIndex import SentenceIndex
+from ResultCache import ResultCache
+from ModelRegistry import LazyModule, LazyModel, shared_models
+
+# torch and transformers are imported on first use
+torch = LazyModule("torch")
+AutoTokenizer = LazyModule("transformers", "AutoTokenizer")
+AutoModelForSeq2SeqLM = LazyModule("transformers", "AutoModelForSeq2SeqLM")
+AutoConfig = LazyModule("transformers", "AutoConfig")
+GenerationConfig = LazyModule("transformers", "GenerationConfig")
+
+# the model replica of a worker process, loaded once by the pool initializer
+_worker_errorifier = None
+
+def _init_round_trip_worker(init_kwargs):
+    global _worker_errorifier
+    _worker_errorifier = RoundTripErrorifier(**init_kwargs)
+
+def _round_trip_chunk(chunk):
+    return _worker_errorifier.round_trip_many(chunk)
+
+# end of the stream passed through the pipeline queues
+_DONE = object()
+
+class _StageFailure(object):
+    # an exception raised in a stage, handed down to the consumer
+    def __init__(self, error):
+        self.error = error
+
+# how often a stage blocked on a full or an empty queue checks whether the pipeline was stopped
+_POLL_SECONDS = 0.1
+
+def _put(out_queue, item, stop):
+    # waits for room in out_queue until the pipeline is stopped; False if it was
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(in_queue, stop):
+    # the next item of in_queue, or the end of the stream once the pipeline is stopped
+    while not stop.is_set():
+        try:
+            return in_queue.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            pass
+    return _DONE
+
+def _run_stage(fn, in_queue, out_queue, stop):
+    # applies fn to every (meta, payload) item of in_queue until the end of the stream or until the pipeline is stopped
+    while True:
+        item = _get(in_queue, stop)
+        if item is _DONE or isinstance(item, _StageFailure):
+            _put(out_queue, item, stop)
+            return
+        meta, payload = item
+        try:
+            result = (meta, fn(payload))
+        except BaseException as error:
+            _put(out_queue, _StageFailure(error), stop)
+            return
+        if not _put(out_queue, result, stop):
+            return
 
 class RoundTripErrorifier(object):
     """
     Makes tagged and human-readable grammar errors in data.
     """
-    def __init__(self):
-        self.tokenizer = AutoTokenizer.from_pretrained("Helsinki-NLP/opus-mt-uk-ru")
-        self.model = AutoModelForSeq2SeqLM.from_pretrained("Helsinki-NLP/opus-mt-uk-ru")
-        self.tokenizer2 = AutoTokenizer.from_pretrained("Helsinki-NLP/opus-mt-ru-uk")
-        self.model2 = AutoModelForSeq2SeqLM.from_pretrained("Helsinki-NLP/opus-mt-ru-uk")
+    # the tokenizers and the models are loaded from the registry on first use
+    tokenizer = LazyModel("marian-tokenizer:Helsinki-NLP/opus-mt-uk-ru")
+    model = LazyModel(lambda self: self.registry_name("Helsinki-NLP/opus-mt-uk-ru"))
+    tokenizer2 = LazyModel("marian-tokenizer:Helsinki-NLP/opus-mt-ru-uk")
+    model2 = LazyModel(lambda self: self.registry_name("Helsinki-NLP/opus-mt-ru-uk"))
+
+    def __init__(self, batch_size=32, max_length=512, quantize=False, num_threads=None, interop_threads=None, models=None, cache_path=None):
+        self.models = shared_models if models is None else models # shared with the other errorifiers of the process by default
+        for name in ("Helsinki-NLP/opus-mt-uk-ru", "Helsinki-NLP/opus-mt-ru-uk"):
+            self.models.register("marian-tokenizer:" + name, lambda models, name=name: AutoTokenizer.from_pretrained(name))
+            self.models.register("marian:" + name, lambda models, name=name: AutoModelForSeq2SeqLM.from_pretrained(name))
+            self.models.register("marian-int8:" + name, lambda models, name=name: self.load_quantized(models, name))
+        self.stream_handler = StreamHandler()
+        self.batch_size = batch_size # sentences per generate call
+        self.max_length = max_length # longest input/output in tokens
+        self.init_kwargs = {"batch_size": batch_size, "max_length": max_length, "quantize": quantize} # how the replicas build their own copy
+        self.cpu_mode(num_threads, interop_threads)
+        self.quantized = quantize
+        # the round trips kept on disk between the runs, by the models and the generation settings that made them
+        self.result_cache = None
+        if cache_path is not None:
+            self.result_cache = ResultCache(cache_path, "round-trip", self.cache_version())
+
+    def registry_name(self, name):
+        # the registry name of the model in use, int8 if quantized
+        return ("marian-int8:" if self.quantized else "marian:") + name
+
+    def model_version(self, name):
+        """ The revision and the generation settings of a model: the hub commit, or the path and a hash of the config of a local copy """
+        if self.models.loaded(self.registry_name(name)):
+            model = self.models.get(self.registry_name(name))
+            config, generation = model.config, model.generation_config
+        else:
+            # only the config files are read, the weights are loaded on first use
+            config = AutoConfig.from_pretrained(name)
+            try:
+                generation = GenerationConfig.from_pretrained(name)
+            except OSError: # older checkpoints keep the generation settings in the model config
+                generation = GenerationConfig.from_model_config(config)
+        settings = generation.to_diff_dict()
+        settings.pop("transformers_version", None)
+        settings["max_length"] = self.max_length # overridden by generate
+        revision = getattr(config, "_commit_hash", None)
+        if revision is None:
+            config_dict = config.to_diff_dict()
+            config_dict.pop("transformers_version", None)
+            revision = config.name_or_path + "#" + hashlib.blake2b(json.dumps(config_dict, sort_keys=True).encode('utf-8'), digest_size=8).hexdigest()
+        return f"{self.registry_name(name)}@{revision}:beams={generation.num_beams}:{json.dumps(settings, sort_keys=True)}"
+
+    def cache_version(self):
+        # a new model revision or other generation settings make new keys
+        return f"{self.model_version('Helsinki-NLP/opus-mt-uk-ru')}>{self.model_version('Helsinki-NLP/opus-mt-ru-uk')}"
+
+    def load_quantized(self, models, name):
+        # the fp32 model is only kept if something else loaded it
+        if models.loaded("marian:" + name):
+            return self.quantize_model(models.get("marian:" + name))
+        return self.quantize_model(AutoModelForSeq2SeqLM.from_pretrained(name))
+
+    def cpu_mode(self, num_threads=None, interop_threads=None):
+        """ Pins the intra-op and inter-op thread counts of torch; None keeps the default """
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        # the inter-op pool can only be sized before it is first used
+        if interop_threads is not None and interop_threads != torch.get_num_interop_threads():
+            torch.set_num_interop_threads(interop_threads)
+
+    def quantize_model(self, model):
+        """ A dynamically quantized int8 copy of the model; only the Linear layers are quantized """
+        return torch.quantization.quantize_dynamic(copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8)
+
+    def quantize_models(self):
+        return tuple(self.quantize_model(model) for model in (self.model, self.model2))
 
     def setup(self):
         # setting device on GPU if available, else CPU
@@ -26,36 +169,266 @@ class RoundTripErrorifier(object):
             print('Allocated:', round(torch.cuda.memory_allocated(0)/1024**3,1), 'GB')
             print('Cached:   ', round(torch.cuda.memory_reserved(0)/1024**3,1), 'GB')
 
-    def main(self, input_file, out_folder):
+    def encode(self, tokenizer, sentences):
+        # one padded batch
+        return tokenizer(sentences, return_tensors="pt", padding=True, truncation=True, max_length=self.max_length)
+
+    def generate(self, model, batch):
+        with torch.inference_mode():
+            return model.generate(**batch, max_length=self.max_length)
+
+    def decode(self, tokenizer, translated):
+        return [tokenizer.decode(t, skip_special_tokens=True) for t in translated]
+
+    def translate(self, tokenizer, model, sentences):
+        # one padded batch through one of the models
+        return self.decode(tokenizer, self.generate(model, self.encode(tokenizer, sentences)))
+
+    def round_trip_batch(self, sentences):
+        # uk -> ru -> uk
+        out = self.translate(self.tokenizer, self.model, sentences)
+        return self.translate(self.tokenizer2, self.model2, out)
+
+    def round_trip_many(self, sentences):
+        """
+        Round-translates a list of sentences in batches of similar length, so that little of every batch is padding.
+        The results come back in the original order.
+        """
+        order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+        corrupted = [None] * len(sentences)
+        for start in range(0, len(order), self.batch_size):
+            bucket = order[start:start + self.batch_size]
+            for i, sentence in zip(bucket, self.round_trip_batch([sentences[i] for i in bucket])):
+                corrupted[i] = sentence
+        return corrupted
+
+    def compare_quantized(self, sentences):
+        """
+        Round-translates the sentences with the fp32 and the int8 models
+        and reports the throughput of both and how often their outputs agree.
+        """
+        if self.quantized:
+            raise ValueError("The models are already quantized, compare_quantized needs an errorifier built with quantize=False")
+        fp32 = (self.model, self.model2)
+        int8 = self.quantize_models()
+        report = {}
+        outputs = {}
+        try:
+            for name, (model, model2) in (("fp32", fp32), ("int8", int8)):
+                self.model, self.model2 = model, model2
+                t0 = time.time()
+                outputs[name] = self.round_trip_many(sentences)
+                elapsed = time.time() - t0
+                report[name] = {"seconds": elapsed, "sentences_per_second": len(sentences) / elapsed if elapsed else float("inf")}
+        finally:
+            self.model, self.model2 = fp32
+        agreed = sum(a == b for a, b in zip(outputs["fp32"], outputs["int8"]))
+        report["agreement"] = agreed / len(sentences) if sentences else 1.0
+        report["speedup"] = report["fp32"]["seconds"] / report["int8"]["seconds"] if report["int8"]["seconds"] else float("inf")
+        print(f"fp32: {report['fp32']['sentences_per_second']:.3} sentences/s, int8: {report['int8']['sentences_per_second']:.3} sentences/s, "
+              f"identical outputs: {report['agreement']:.1%}")
+        return report
+
+    def length_batches(self, chunks):
+        # yields ((chunk id, chunk, positions of the batch in the chunk, number of batches in the chunk), batch) in length order
+        for chunk_id, chunk in enumerate(chunks):
+            order = sorted(range(len(chunk)), key=lambda i: len(chunk[i]))
+            n_batches = (len(order) + self.batch_size - 1) // self.batch_size
+            for start in range(0, len(order), self.batch_size):
+                bucket = order[start:start + self.batch_size]
+                yield (chunk_id, chunk, bucket, n_batches), [chunk[i] for i in bucket]
+
+    def pipelined_round_trip(self, chunks, queue_size=4, tokenizer_threads=2):
+        """
+        Yields (chunk, round-translated chunk) pairs in order, running the round trip as a pipeline:
+        tokenize -> uk->ru generate -> decode and re-encode -> ru->uk generate -> decode.
+        Each model has its own thread, tokenization runs on a thread pool, and the stages are joined by queues
+        of at most queue_size batches, so both models work at the same time while the memory stays bounded.
+        If the consumer stops early, the stages are stopped and joined before the generator closes.
+        """
+        queues = [queue.Queue(maxsize=queue_size) for i in range(4)]
+        pool = ThreadPoolExecutor(max_workers=tokenizer_threads)
+        stop = threading.Event()
+
+        def tokenize():
+            # the pool encodes several batches ahead, in order
+            try:
+                batches = deque()
+                def feed():
+                    for meta, batch in self.length_batches(chunks):
+                        batches.append(meta)
+                        yield batch
+                for encoded in self.stream_handler.ordered_map(pool, lambda batch: self.encode(self.tokenizer, batch), feed(), tokenizer_threads):
+                    if not _put(queues[0], (batches.popleft(), encoded), stop):
+                        return
+                _put(queues[0], _DONE, stop)
+            except BaseException as error:
+                _put(queues[0], _StageFailure(error), stop)
+
+        def re_encode(translated):
+            return self.encode(self.tokenizer2, self.decode(self.tokenizer, translated))
+
+        stages = [threading.Thread(target=tokenize, daemon=True),
+                  threading.Thread(target=_run_stage, args=(lambda batch: self.generate(self.model, batch), queues[0], queues[1], stop), daemon=True),
+                  threading.Thread(target=_run_stage, args=(re_encode, queues[1], queues[2], stop), daemon=True),
+                  threading.Thread(target=_run_stage, args=(lambda batch: self.generate(self.model2, batch), queues[2], queues[3], stop), daemon=True)]
+        for stage in stages:
+            stage.start()
+
+        try:
+            corrupted, done_batches = None, 0
+            while True:
+                item = queues[3].get()
+                if item is _DONE:
+                    return
+                if isinstance(item, _StageFailure):
+                    raise item.error
+                (chunk_id, chunk, bucket, n_batches), translated = item
+                if done_batches == 0:
+                    corrupted = [None] * len(chunk)
+                for i, sentence in zip(bucket, self.decode(self.tokenizer2, translated)):
+                    corrupted[i] = sentence
+                done_batches += 1
+                if done_batches == n_batches: # the chunk is complete
+                    yield chunk, corrupted
+                    done_batches = 0
+        finally:
+            # stopping the stages, dropping the batches in flight and waiting for the current ones to finish
+            stop.set()
+            for q in queues:
+                while True:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+            for stage in stages:
+                stage.join()
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def round_trip_chunks(self, chunks, replicas=None, pipelined=False):
+        """
+        Yields (chunk, round-translated chunk) pairs in order. With replicas=N the chunks are spread over N processes,
+        each holding its own single-threaded copy of the models; this scales better over the cores than one multi-threaded copy.
+        With pipelined=True a single process overlaps the two translation directions, see pipelined_round_trip.
+        With a result cache, only the sentences no earlier run has translated are translated.
+        """
+        if self.result_cache is not None:
+            return self.cached_round_trip_chunks(chunks, lambda missing: self.translate_chunks(missing, replicas, pipelined))
+        return self.translate_chunks(chunks, replicas, pipelined)
+
+    def cached_round_trip_chunks(self, chunks, translate):
+        # the cached sentences of every chunk are looked up, the others are translated in chunks of their own
+        pending = deque()
+        def feed():
+            for chunk in chunks:
+                found = self.result_cache.get_many(chunk)
+                missing = [sentence for sentence in dict.fromkeys(chunk) if sentence not in found]
+                pending.append((chunk, found, missing))
+                if missing:
+                    yield missing
+
+        def complete():
+            chunk, found, missing = pending.popleft()
+            return chunk, [found[sentence] for sentence in chunk]
+
+        for missing, translated in translate(feed()):
+            while not pending[0][2]: # translated entirely by earlier runs
+                yield complete()
+            results = dict(zip(missing, translated))
+            self.result_cache.put_many(results)
+            pending[0][1].update(results)
+            yield complete()
+        while pending:
+            yield complete()
+
+    def translate_chunks(self, chunks, replicas=None, pipelined=False):
+        # the round trip of every chunk, see round_trip_chunks
+        if pipelined and (replicas is None or replicas <= 1):
+            for pair in self.pipelined_round_trip(chunks):
+                yield pair
+            return
+        if replicas is None or replicas <= 1:
+            for chunk in chunks:
+                yield chunk, self.round_trip_many(chunk)
+            return
+
+        # the chunks in flight, oldest first, to pair them with their results
+        pending = deque()
+        def feed():
+            for chunk in chunks:
+                pending.append(chunk)
+                yield chunk
+
+        init_kwargs = dict(self.init_kwargs, num_threads=1, interop_threads=1)
+        # spawning, since forking after torch has started its thread pools can hang the workers
+        with ProcessPoolExecutor(max_workers=replicas, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_round_trip_worker, initargs=(init_kwargs,)) as executor:
+            for corrupted in self.stream_handler.ordered_map(executor, _round_trip_chunk, feed(), 2 * replicas):
+                yield pending.popleft(), corrupted
+
+    def round_trip(self, sentence):
+        # round-translating the sentence
+        return self.round_trip_batch([sentence])[0]
+
+    def main(self, input_file, out_folder, stream=False, chunk_size=4096, replicas=None, pipelined=False, checkpoint=False, resume=False,
+             dedup=False, dedup_index=None):
+        """
+        chunk_size sentences are sorted by length together before being cut into batches.
+        replicas=N runs N single-threaded model replicas in parallel processes.
+        pipelined=True overlaps the uk->ru and ru->uk passes in one process.
+        checkpoint=True flushes every translated chunk to out_folder/checkpoints; resume=True skips the chunks
+        translated by an interrupted run. With stream=True only the input offset and the sizes of source.txt/target.txt
+        are flushed, and a resumed run appends to them.
+        dedup=True skips empty lines and duplicate sentences before translating them; with dedup_index, a path to an .npy file,
+        the sentences seen by earlier runs are skipped too and the index is updated at the end (see SentenceIndex).
+        """
         self.setup()
         # creating the output folder
         if not os.path.exists(out_folder):
             os.mkdir(out_folder)
 
+        if stream:
+            return self.main_stream(input_file, out_folder, chunk_size, replicas, pipelined, dedup, dedup_index, checkpoint, resume)
+
         # reading the file
         with open(input_file, 'r') as f:
             text = f.read()
             lines = text.split('\n')
 
+        # skipping the empty lines and the sentences seen before
+        index = SentenceIndex(dedup_index) if dedup or dedup_index else None
+        if index is not None:
+            lines = index.filter(lines)
+
         s = time.time()
         final_list = []
         t0 = time.time()
         unprocessed_counter = 0
 
-        # traversing through the list
-        for i in range(len(lines)):
-            sentence = lines[i]
-            # round-translating the sentence
-            translated = self.model.generate(**self.tokenizer(sentence, return_tensors="pt", padding=True))
-            out = [self.tokenizer.decode(t, skip_special_tokens=True) for t in translated]
-            translated = self.model2.generate(**self.tokenizer(out, return_tensors="pt", padding=True))
-            corrupted = [self.tokenizer2.decode(t, skip_special_tokens=True) for t in translated]
-            # adding the sentence to the list
-            final_list.append(corrupted[0])
+        checkpointer = None
+        start = 0
+        if checkpoint or resume:
+            settings = {"input_file": input_file, "chunk_size": chunk_size, "max_length": self.max_length, "quantize": self.quantized}
+            if index is not None: # the deduplicated lines are chunked differently
+                settings["dedup"] = True
+            checkpointer = Checkpointer(out_folder + "/checkpoints", settings, resume)
+            start = checkpointer.offset # the lines translated before the interruption
+
+        # traversing through the list chunk by chunk
+        i = start
+        for chunk, corrupted in self.round_trip_chunks(self.stream_handler.chunked(lines[start:], chunk_size), replicas, pipelined):
+            i += len(chunk)
+            if checkpointer is not None:
+                checkpointer.save_chunk(corrupted, i)
+            else:
+                # adding the round-translated sentences to the list
+                final_list.extend(corrupted)
             # estimating the time left
-            if i != 0 and not i % 1000:
-                print(f"{i} sentences were processed\nProjected time till the end: {(time.time() - t0)/3600/i*(len(lines)-i):.2} hours")
-                print(f"{unprocessed_counter} sentences were not processed.")
+            print(f"{i} sentences were processed\nProjected time till the end: {(time.time() - t0)/3600/(i-start)*(len(lines)-i):.2} hours")
+            print(f"{unprocessed_counter} sentences were not processed.")
+
+        if checkpointer is not None:
+            final_list = [corrupted for chunk in checkpointer.load_chunks() for corrupted in chunk]
 
         text = '\n'.join(final_list)
         with open(out_folder + "/source.txt", 'w') as f:
@@ -64,4 +437,46 @@ class RoundTripErrorifier(object):
 
         text = '\n'.join(lines)
         with open(out_folder + "/target.txt", 'w') as f:
-            f.write(text)
\ No newline at end of file
+            f.write(text)
+        if index is not None:
+            index.finish()
+
+    def main_stream(self, input_file, out_folder, chunk_size=4096, replicas=None, pipelined=False, dedup=False, dedup_index=None,
+                    checkpoint=False, resume=False):
+        s = time.time()
+        i = 0
+        lines = self.stream_handler.read_lines(input_file)
+        # skipping the empty lines and the sentences seen before
+        index = SentenceIndex(dedup_index) if dedup or dedup_index else None
+        if index is not None:
+            lines = index.filter_lines(lines)
+
+        checkpointer = None
+        positions = {"source": None, "target": None}
+        if checkpoint or resume:
+            settings = {"input_file": input_file, "chunk_size": chunk_size, "max_length": self.max_length, "quantize": self.quantized,
+                        "stream": True, "dedup": index is not None}
+            checkpointer = Checkpointer(out_folder + "/checkpoints", settings, resume)
+            i = checkpointer.offset # the lines translated before the interruption
+            positions = checkpointer.counters.get("positions", positions)
+            # they still go through the index, which sees them again as on the first run
+            lines = islice(lines, i, None)
+
+        # writing the source and the target chunk by chunk
+        with self.stream_handler.open_output(out_folder + "/source.txt", positions["source"]) as source, \
+             self.stream_handler.open_output(out_folder + "/target.txt", positions["target"]) as target:
+            chunks = self.stream_handler.chunked(lines, chunk_size)
+            for chunk, corrupted_chunk in self.round_trip_chunks(chunks, replicas, pipelined):
+                for sentence, corrupted in zip(chunk, corrupted_chunk):
+                    prefix = '\n' if i else ''
+                    source.write(prefix + corrupted)
+                    target.write(prefix + sentence)
+                    i += 1
+                if checkpointer is not None:
+                    source.flush()
+                    target.flush()
+                    checkpointer.advance(i, counters={"positions": {"source": source.tell(), "target": target.tell()}})
+                print(f"{i} sentences were processed in {(time.time() - s)/3600:.2} hours")
+        if index is not None:
+            index.finish()
+        print(time.time() - s)
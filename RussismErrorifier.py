@@ -2,22 +2,54 @@ import os
 import time
 import collections
 import random
-from transformers import pipeline
+import heapq
+from functools import lru_cache
 from helpers.classes.SpaceHandler import SpaceHandler
+from TranslationCache import TranslationCache
+from VocabStore import VocabStore
+from SentenceIndex import SentenceIndex
+from ModelRegistry import LazyModule, LazyModel, shared_models
+
+# transformers (and torch with it) is imported on first use
+pipeline = LazyModule("transformers", "pipeline")
+AutoTokenizer = LazyModule("transformers", "AutoTokenizer")
+AutoModelForSeq2SeqLM = LazyModule("transformers", "AutoModelForSeq2SeqLM")
 
 class RussismErrofifier(object):
     """
     Makes tagged and human-readable russism errors in data.
     """
-    def __init__(self):
+    translator = LazyModel(lambda self: f"translator:{self.model_name}:{self.device}") # loaded on the first cache miss
+
+    def __init__(self, cache_path="translation-cache.sqlite", candidate_cache_size=100000, vocab_folder="vocab-store", device=0, models=None):
       self.space_handler = SpaceHandler()
-      self.translator = pipeline(task="translation", model='Helsinki-NLP/opus-mt-uk-ru', device=0)
+      self.model_name = 'Helsinki-NLP/opus-mt-uk-ru'
+      self.device = device # the gpu of the translator, -1 for the cpu
+      self.models = shared_models if models is None else models # shared with the other errorifiers of the process by default
+      self.models.register("marian-tokenizer:" + self.model_name, lambda models: AutoTokenizer.from_pretrained(self.model_name))
+      self.models.register("marian:" + self.model_name, lambda models: AutoModelForSeq2SeqLM.from_pretrained(self.model_name))
+      self.models.register(f"translator:{self.model_name}:{device}", self.load_translator)
+      self.translation_cache = TranslationCache(cache_path, self.model_name) # word translations shared between runs
+      self.vowels = "ауоиеіє" # the vowels the russisms get confused with
+      self.vocab_folder = vocab_folder
+      self.generate_vocab() # the wordlist and the frequency vocabulary, memory-mapped
+      self.candidate_cache = lru_cache(maxsize=candidate_cache_size)(self.find_surzhik_candidates) # memoized per russian word
+
+    def load_translator(self, models):
+      # on the cpu the pipeline runs on the weights shared with the round trip errorifier;
+      # a pipeline on a gpu moves its model there, so it gets a copy of its own
+      if self.device < 0:
+        return pipeline(task="translation", model=models.get("marian:" + self.model_name),
+                        tokenizer=models.get("marian-tokenizer:" + self.model_name), device=-1)
+      return pipeline(task="translation", model=self.model_name, device=self.device)
 
     # AY: I have no idea what any of the following does.
     # I can't attest that it is able to produce any output or even compiles
     # If you have any idea of what's going on or how to improve it, feel free to open a pull request
-    def antichanger(self, cor_word):
-      start = time.time()
+    # The rules rewrite a russian word into ukrainian-looking variants; the vowel substitutions
+    # blow the set up, so find_surzhik_candidates walks them against the vocabulary instead.
+    def base_variants(self, cor_word):
+      """ Variants of the word after the replacement, ending and exception rules, before any vowel substitution """
       res = set()
       res.add(cor_word.lower())
 
@@ -33,23 +65,6 @@ class RussismErrofifier(object):
               temp.append(x)
           res.update(set(temp))
 
-      def function_all_to_all():
-        lt = "ауоиеіє"
-        for c1 in lt:
-          for c2 in lt:
-            if c1 != c2:
-              temp = list()
-              for st in res:
-                  for i in range(len(st)) :
-                    if (st[i] == c1):
-                        x = st[:i] + c2 + st[ i + 1:]
-                        temp.append(x);
-                    x = st.replace(c1, c2)
-                    temp.append(x)
-              res.update(set(temp))
-              if len(res) > 10000:
-                return 
-      
       def function_all_ending():
           temp = list()
           dict_end = {"тись" : "ться", "овать" : "увати",  "ать" : "ати", "леть" : "літи",
@@ -76,9 +91,9 @@ class RussismErrofifier(object):
                   x =  "із"+ st[pos+2:] 
                   temp.append(x)
 
-            if(st[-1] == "я" and st[-2] in "ауеоиіїяює"):
+            if(len(st) > 1 and st[-1] == "я" and st[-2] in "ауеоиіїяює"):
               temp.append(st[:-1])
-            if(st[-1] == "ц"):
+            if(st and st[-1] == "ц"):
               temp.append(st+"ь")
             
 
@@ -88,43 +103,90 @@ class RussismErrofifier(object):
       function_all_ending()
       
       function_exeption()
+
+      return res
+
+    def antichanger(self, cor_word):
+      res = self.base_variants(cor_word)
+
+      def function_all_to_all():
+        lt = self.vowels
+        for c1 in lt:
+          for c2 in lt:
+            if c1 != c2:
+              temp = list()
+              for st in res:
+                  for i in range(len(st)) :
+                    if (st[i] == c1):
+                        x = st[:i] + c2 + st[ i + 1:]
+                        temp.append(x);
+                    x = st.replace(c1, c2)
+                    temp.append(x)
+              res.update(set(temp))
+              if len(res) > 10000:
+                return 
       
       function_all_to_all()
       
       return set(res)
 
+    def vowel_variants(self, base):
+      """
+      Vocabulary words reachable from base by substituting any of its vowels, as {word: frequency}.
+      The substitutions are walked along the vocabulary store, so a branch stops as soon as no word starts with it.
+      """
+      index = self.vocab_store
+      found = {}
+      stack = [(index.root(), 0)]
+      while stack:
+        node, j = stack.pop()
+        if j == len(base):
+          frequency = index.frequency(node)
+          if frequency is not None:
+            found[index.word(node)] = frequency
+          continue
+        for c in (self.vowels if base[j] in self.vowels else base[j]):
+          child = index.child(node, c)
+          if child is not None:
+            stack.append((child, j + 1))
+      return found
+
+    def find_surzhik_candidates(self, work_rus, k=4):
+      """
+      The k most frequent surzhik candidates for a russian word, most frequent first, and the number of all the candidates.
+      The variant is drawn with the number of all of them, but never past the 4th one, so k=4 is all that is kept.
+      """
+      found = {}
+      for base in self.base_variants(work_rus):
+        found.update(self.vowel_variants(base))
+      # the candidates must not be real ukrainian words nor the russian word itself
+      candidates = [(frequency, word) for word, frequency in found.items() if not self.vocab_store.in_wordlist(word) and word != work_rus]
+      return [word for frequency, word in heapq.nsmallest(k, candidates, key=lambda item: (-item[0], item[1]))], len(candidates)
+
     "For getting prob of error"
     def random_replace(self, prob):
       gen = random.randint(0, 100) / 100
       return gen < prob
 
-    "For batch translating ukr to rus"
+    "For batch translating ukr to rus. Only the unique words missing from the cache are sent to the translator"
     def translate_and_append(self, words_to_errorify):
-      wordset = [word[0] for word in words_to_errorify]
-      translated = self.translator(wordset, batch_size=64)
-      translated = [sent['translation_text'].lower() for sent in translated]
+      unique_words = list(dict.fromkeys(word[0] for word in words_to_errorify))
+      translations = self.translation_cache.get_many(unique_words)
+      misses = [word for word in unique_words if word not in translations]
+      if misses:
+        translated = self.translator(misses, batch_size=64)
+        new_translations = {word: sent['translation_text'].lower() for word, sent in zip(misses, translated)}
+        self.translation_cache.put_many(new_translations)
+        translations.update(new_translations)
+      # fanning the translations back out to every occurrence
       for i in range(len(words_to_errorify)):
-        words_to_errorify[i].append(translated[i])
+        words_to_errorify[i].append(translations[words_to_errorify[i][0]])
       return words_to_errorify
 
     def generate_vocab(self):
-      # impport list of all ukr words
-      words = list()
-      with open('helpers/dicts/wordlist.txt') as f:
-          for line in f:
-            if line:
-              words.append(line.replace("\n", ""))
-      words = set(words)
-
-      #import frequency vocab
-      myfile = open("helpers/dicts//frequency-vocab.txt", 'r')
-      frequence_dict = {}
-      for line in myfile:
-          k, v = line.strip().split()
-          frequence_dict[k.strip()] = int(v.strip())
-
-      vocab = set(frequence_dict.keys())
-      return vocab
+      # compiling the wordlist and the frequency vocab into the memory-mapped store, once
+      self.vocab_store = VocabStore.open(self.vocab_folder, 'helpers/dicts/wordlist.txt', 'helpers/dicts/frequency-vocab.txt')
+      return self.vocab_store
 
     'Main function. Takes in list of corr sentences, outputs list of incorr sentences'
     def errorify_rus_dataset(self, dataset, prob):
@@ -153,12 +215,10 @@ class RussismErrofifier(object):
         is_capital = (word_ukr.capitalize() == word_ukr)
         if word_ukr == work_rus or len(word_ukr) < 2:
           continue
-        interim = (set(self.antichanger(work_rus) )& vocab ) - words - set([work_rus]) 
-        new_dict = {i:frequence_dict[i] for i in (interim)}
-        variants = [pair[0] for pair in sorted(new_dict.items(), key=lambda item: -item[1])]
-        i = random.randint(0, (len(variants)-1) %4)
+        variants, n_variants = self.candidate_cache(work_rus)
+        i = random.randint(0, (n_variants-1) %4)
         # if variants[i] does not exist (i dont know why it wouldn't) we skip
-        if len(variants)==0:
+        if n_variants==0:
           continue
         suggested_surzhik = variants[i]
         if is_capital:
@@ -167,10 +227,14 @@ class RussismErrofifier(object):
 
       output_sentences = []
       for sentence in all_sentences:
-        output_sentences.append(space_handler.fried_nails(" ".join(sentence)).replace("ʼ ", "ʼ"))
+        output_sentences.append(self.space_handler.fried_nails(" ".join(sentence)).replace("ʼ ", "ʼ"))
       return output_sentences
 
-    def main(self, input_file, out_folder):
+    def main(self, input_file, out_folder, dedup=False, dedup_index=None):
+      """
+      dedup=True skips empty lines and duplicate sentences before translating their words; with dedup_index, a path to an .npy file,
+      the sentences seen by earlier runs are skipped too and the index is updated at the end (see SentenceIndex).
+      """
       # creating the output folder
       if not os.path.exists(out_folder):
         os.mkdir(out_folder)
@@ -180,10 +244,17 @@ class RussismErrofifier(object):
         text = f.read()
         lines = text.split('\n')
 
+      # skipping the empty lines and the sentences seen before
+      index = SentenceIndex(dedup_index) if dedup or dedup_index else None
+      if index is not None:
+        lines = index.filter(lines)
+
       s = time.time()
-      out = self.errorify_rus_dataset(dataset,0.01)
+      out = self.errorify_rus_dataset(lines,0.01)
       print(time.time() - s)
       output_sentences = [sent + '\n' for sent in out]
       with open(out_folder + "/russism-applied", 'w') as f:
         f.writelines(output_sentences)
+      if index is not None:
+        index.finish()
       print("Done!")
\ No newline at end of file
@@ -0,0 +1,93 @@
+import os
+import hashlib
+import numpy as np
+from collections import Counter
+from helpers.classes.SpaceHandler import SpaceHandler
+from StreamHandler import StreamHandler
+
+class SentenceIndex(object):
+    """
+    Skips empty lines and duplicate sentences before they reach the expensive stages of an errorifier.
+    A sentence is known by the 64-bit hash of its fried_nails normalization. The hashes are kept as sorted uint64 arrays,
+    8 bytes per sentence: every chunk adds a sorted run, and runs of similar sizes are merged, so a lookup is a binary search
+    in a few arrays. With a path, the index is loaded from (memory-mapped) and saved to an .npy file, so a run on
+    a grown corpus only processes the sentences no earlier run has seen.
+    """
+    def __init__(self, path=None, space_handler=SpaceHandler(), stream_handler=StreamHandler()):
+        self.path = path
+        self.space_handler = space_handler
+        self.stream_handler = stream_handler
+        self.runs = [] # sorted hash arrays, longest first
+        if path is not None and os.path.exists(path):
+            self.runs.append(np.load(path, mmap_mode='r'))
+        self.counts = Counter() # lines, empty, duplicates, kept
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def hashes(self, sentences):
+        # the little-endian 64-bit blake2b digests of the sentences, as one array
+        digests = b''.join(hashlib.blake2b(sentence.encode('utf-8'), digest_size=8).digest() for sentence in sentences)
+        return np.frombuffer(digests, dtype='<u8')
+
+    def contains(self, hashes):
+        """ Which of the hashes are in the index """
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self.runs:
+            if len(run):
+                positions = np.minimum(np.searchsorted(run, hashes), len(run) - 1)
+                found |= run[positions] == hashes
+        return found
+
+    def add(self, hashes):
+        """ Adds sorted hashes that are not in the index yet """
+        if not len(hashes):
+            return
+        run = hashes
+        # merging until every run is more than twice as long as the next one, so that there are at most log2(n) of them
+        while self.runs and len(self.runs[-1]) <= 2 * len(run):
+            run = np.concatenate([self.runs.pop(), run])
+            run.sort(kind='stable') # two sorted runs, merged in linear time
+        self.runs.append(run)
+
+    def filter(self, sentences):
+        """ The sentences that are neither empty nor seen before, in their order; they are added to the index """
+        # exact copies are normalized once
+        normalizations = {sentence: self.space_handler.fried_nails(sentence) for sentence in set(sentences)}
+        normalized = [normalizations[sentence] for sentence in sentences]
+        filled = [i for i, sentence in enumerate(normalized) if sentence]
+        # the first occurrence of every hash in the chunk, then only the ones the index does not know
+        unique, first = np.unique(self.hashes([normalized[i] for i in filled]), return_index=True)
+        new = ~self.contains(unique)
+        self.add(unique[new])
+        kept = [sentences[filled[i]] for i in np.sort(first[new]).tolist()]
+
+        self.counts["lines"] += len(sentences)
+        self.counts["empty"] += len(sentences) - len(filled)
+        self.counts["duplicates"] += len(filled) - len(kept)
+        self.counts["kept"] += len(kept)
+        return kept
+
+    def filter_lines(self, lines, chunk_size=10000):
+        """ Streaming filter: yields the new sentences of lines, hashed chunk by chunk """
+        for chunk in self.stream_handler.chunked(lines, chunk_size):
+            for sentence in self.filter(chunk):
+                yield sentence
+
+    def save(self, path=None):
+        """ Writes all the hashes as one sorted array; atomically, so that an interrupted save keeps the old index """
+        path = self.path if path is None else path
+        merged = np.concatenate(self.runs) if self.runs else np.zeros(0, dtype='<u8')
+        merged.sort()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, merged)
+        os.replace(tmp_path, path)
+        self.runs = [merged]
+
+    def finish(self):
+        """ Reports what was skipped and saves the index if it has a path """
+        print(f"Out of {self.counts['lines']} lines, {self.counts['empty']} empty lines and {self.counts['duplicates']} duplicates were skipped.")
+        if self.path is not None:
+            self.save()
+        return dict(self.counts)
@@ -0,0 +1,114 @@
+import os
+import json
+import hashlib
+from itertools import islice
+from collections import deque
+from ColumnarDataset import ColumnarWriter
+
+class StreamHandler(object):
+    """
+    Reads corpora lazily and writes errorified records incrementally,
+    so the memory used by a run does not grow with the size of the corpus.
+    """
+    def __init__(self, dev_fraction=0.2, salt="47"):
+        self.dev_fraction = dev_fraction
+        self.salt = salt
+
+    def read_lines(self, input_file, limit=None):
+        """ Yields the lines of the file one by one, without the trailing newline """
+        with open(input_file, 'r') as f:
+            lines = (line.rstrip('\n') for line in f)
+            for line in islice(lines, limit):
+                yield line
+
+    def open_output(self, path, position=None):
+        """
+        Opens an output file for writing; with position, the size of the file at a checkpoint,
+        the file is cut back to it and appended to, dropping what an interrupted run wrote after the checkpoint.
+        """
+        if position is None:
+            return open(path, 'w')
+        os.truncate(path, position)
+        return open(path, 'a')
+
+    def chunked(self, iterable, size):
+        """ Yields lists of at most size consecutive items """
+        iterator = iter(iterable)
+        while True:
+            chunk = list(islice(iterator, size))
+            if not chunk:
+                return
+            yield chunk
+
+    def ordered_map(self, executor, fn, iterable, window, depth=None):
+        """
+        Like executor.map, but keeps at most window tasks in flight instead of submitting the whole iterable.
+        Results come back in the input order. depth, if given, is called with the number of tasks in flight.
+        """
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if depth is not None:
+                depth(len(pending))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def is_dev(self, key):
+        """
+        Streaming replacement for train_test_split: a record goes to dev if the hash of its key falls into dev_fraction.
+        The assignment depends only on the key, so it is stable across runs and needs no memory.
+        """
+        digest = hashlib.blake2b((self.salt + key).encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') / 2**64 < self.dev_fraction
+
+    def split_writer(self, out_folder, extension=".jsonl", columnar=False, state=None):
+        """
+        A writer of the train/dev records: JSON Lines, or memory-mappable id arrays in out_folder/columnar.
+        state, the state() of a JSON Lines writer at a checkpoint, continues its files from there.
+        """
+        if columnar:
+            if state is not None:
+                raise ValueError("A columnar dataset cannot be resumed")
+            return ColumnarWriter(self, out_folder + "/columnar")
+        return SplitWriter(self, out_folder, extension, state)
+
+class SplitWriter(object):
+    """
+    Writes train and dev records as JSON Lines while they are being generated.
+    """
+    def __init__(self, stream_handler, out_folder, extension=".jsonl", state=None):
+        self.stream_handler = stream_handler
+        self.out_folder = out_folder
+        self.extension = extension
+        self.counts = {"train": 0, "dev": 0}
+        self.positions = {split: None for split in self.counts}
+        if state is not None:
+            self.counts = dict(state["counts"])
+            self.positions = dict(state["positions"])
+        self.files = {}
+
+    def __enter__(self):
+        if not os.path.exists(self.out_folder):
+            os.mkdir(self.out_folder)
+        for split in self.counts:
+            self.files[split] = self.stream_handler.open_output(self.out_folder + "/" + split + self.extension, self.positions[split])
+        return self
+
+    def state(self):
+        """ The counts and the file sizes, flushed, for a checkpoint """
+        for f in self.files.values():
+            f.flush()
+        return {"counts": dict(self.counts), "positions": {split: f.tell() for split, f in self.files.items()}}
+
+    def write(self, record, key):
+        split = "dev" if self.stream_handler.is_dev(key) else "train"
+        self.files[split].write(json.dumps(record) + '\n')
+        self.counts[split] += 1
+        return split
+
+    def __exit__(self, *exc):
+        for f in self.files.values():
+            f.close()
+        return False
@@ -1,27 +1,85 @@
 import os
 import sys
 import time
-import spacy_udpipe
-import pymorphy2
-from helpers.classes.Inflector import Inflector
-from helpers.classes.SurzhGenerator import SurzhGenerator
+from helpers.classes.SpaceHandler import SpaceHandler
+from StreamHandler import StreamHandler
+from ModelRegistry import LazyModule, LazyModel, shared_models
+
+# the parser and the morphology are imported on first use
+spacy_udpipe = LazyModule("spacy_udpipe")
+pymorphy2 = LazyModule("pymorphy2")
+Inflector = LazyModule("helpers.classes.Inflector", "Inflector")
+SurzhGenerator = LazyModule("helpers.classes.SurzhGenerator", "SurzhGenerator")
+UDPIPE_MODEL = "helpers/models/mova_institute.udpipe"
 
 class SurzhErrorifier(object):
     """
     Makes surzhik errors in data.
     """
-    def __init__(self):
+    # the models are loaded from the registry on first use; the morphology is the same as the grammar errorifier's
+    morph = LazyModel("pymorphy2:uk")
+    inflector = LazyModel("inflector:uk")
+    spacy_model = LazyModel("udpipe:" + UDPIPE_MODEL)
+    surzhik_generator = LazyModel("surzhik-generator:" + UDPIPE_MODEL)
+
+    def __init__(self, models=None):
         self.space_handler = SpaceHandler()
-        self.morph = pymorphy2.MorphAnalyzer(lang='uk')
-        self.inflector = Inflector(self.morph)
-        self.spacy_model = spacy_udpipe.load_from_path(lang="uk", path="helpers/models/mova_institute.udpipe")
-        self.surzhik_generator = SurzhiksGenerator(self.inflector, self.spacy_model)
+        self.stream_handler = StreamHandler()
+        self.models = shared_models if models is None else models # shared with the other errorifiers of the process by default
+        self.models.register("pymorphy2:uk", lambda models: pymorphy2.MorphAnalyzer(lang='uk'))
+        self.models.register("inflector:uk", lambda models: Inflector(models.get("pymorphy2:uk")))
+        self.models.register("udpipe:" + UDPIPE_MODEL, lambda models: spacy_udpipe.load_from_path(lang="uk", path=UDPIPE_MODEL))
+        self.models.register("surzhik-generator:" + UDPIPE_MODEL,
+                             lambda models: SurzhGenerator(models.get("inflector:uk"), models.get("udpipe:" + UDPIPE_MODEL)))
+
+    def surzhify(self, sent):
+        surzhik_generator = self.surzhik_generator # outside the try, so that a model failing to load is not taken for a bad sentence
+        try:
+            out_sentence = surzhik_generator.antisurzhifier(sent)
+            out_sentence = self.space_handler.fried_nails(out_sentence)
+        except:
+            out_sentence = sent
+        return out_sentence
 
-    def main(self, input_file, out_folder):
+    def find_relevant_ids(self, sentences, ukr_key_phrases, per_phrase=None):
+        """
+        Ids of the sentences containing every key word of a key phrase, for each key phrase, in one pass over the sentences.
+        An inverted index from the key words to their phrases means only the phrases sharing a word with the sentence are checked.
+        With per_phrase, every phrase keeps at most that many ids and the scan stops once all of them are full.
+        """
+        ukr_key_words = [key_phrase.split(" ") for key_phrase in ukr_key_phrases]
+        phrases_by_word = {}
+        for key_phrase_id in range(len(ukr_key_phrases)):
+            for word in set(ukr_key_words[key_phrase_id]):
+                phrases_by_word.setdefault(word, []).append(key_phrase_id)
+
+        relevant_id = {key_phrase: [] for key_phrase in ukr_key_phrases}
+        open_phrases = set(relevant_id)
+        for sent_id, line in enumerate(sentences):
+            # a key word is present if it stands between two spaces, so the first and the last piece do not count
+            pieces = self.space_handler.space_oddity(line).split(" ")
+            present = set(pieces[1:-1])
+            candidates = set()
+            for word in present:
+                candidates.update(phrases_by_word.get(word, ()))
+            for key_phrase_id in sorted(candidates):
+                key_phrase = ukr_key_phrases[key_phrase_id]
+                if key_phrase in open_phrases and all(word in present for word in ukr_key_words[key_phrase_id]):
+                    relevant_id[key_phrase].append(sent_id)
+                    if per_phrase is not None and len(relevant_id[key_phrase]) >= per_phrase:
+                        open_phrases.discard(key_phrase)
+            if not open_phrases: # enough sentences for every phrase
+                break
+        return relevant_id
+
+    def main(self, input_file, out_folder, stream=False, per_phrase=20):
         # creating the output folder
         if not os.path.exists(out_folder):
             os.mkdir(out_folder)
 
+        if stream:
+            return self.main_stream(input_file, out_folder, per_phrase)
+
         # reading the file
         with open(input_file, 'r') as f:
             text = f.read()
@@ -29,48 +87,23 @@ class SurzhErrorifier(object):
 
         dataset = lines
         # extract ukr key phrases which to look for
-        ukr_key_phrases = [word[1][:-1] for word in surzhik_generator.surzhiks2]
-        # convert it to pairs of keywords
-        ukr_key_words = []
-        for key_phrase in ukr_key_phrases:
-            words = key_phrase.split(" ")
-            ukr_key_words.append(words)
+        ukr_key_phrases = [word[1][:-1] for word in self.surzhik_generator.surzhiks2]
 
-        # extract ids of relevant sentences (those that contain all key words for given keyword pair)
-        relevant_id = {}
-        for key_phrase in ukr_key_phrases:
-            relevant_id[key_phrase] = []
-        for sent_id in range(len(dataset)):
-            sentence = space_handler.space_oddity(dataset[sent_id])
-            for key_phrase_id in range(len(ukr_key_phrases)):
-                phrase_present = True
-                for word in ukr_key_words[key_phrase_id]:
-                    # if any word is not present, phrase_present = false
-                    el = " " + word + " "
-                    phrase_present = phrase_present and (el in sentence)
-                if phrase_present:
-                    relevant_id[ukr_key_phrases[key_phrase_id]].append(sent_id)
-
-        # extract # of  sentences for each category 
-        for key_phrase in ukr_key_phrases:
-            print(key_phrase + ': ' + str(len(relevant_id[key_phrase])))
-        
-        # extract 20 sentences for each category
+        # extract ids of relevant sentences (those that contain all key words for given keyword pair), 20 for each category
+        relevant_id = self.find_relevant_ids(dataset, ukr_key_phrases, per_phrase)
+
+        # extract # of  sentences for each category
         idxs_to_surzhify = []
         for key_phrase in ukr_key_phrases:
-        idxs_to_surzhify += relevant_id[key_phrase][:20]
+            print(key_phrase + ': ' + str(len(relevant_id[key_phrase])))
+            idxs_to_surzhify += relevant_id[key_phrase]
 
         sentences_to_surzhify = [dataset[id] for id in idxs_to_surzhify]
 
         s = time.time()
         out_sentences =[]
         for sent in sentences_to_surzhify:
-            try:
-                out_sentence = surzhik_generator.antisurzhifier(sent)
-                out_sentence = space_handler.fried_nails(out_sentence)
-            except:
-                out_sentence = sent
-            out_sentences.append(out_sentence)
+            out_sentences.append(self.surzhify(sent))
         print(time.time() - s)
 
         text = '\n'.join(out_sentences)
@@ -81,4 +114,34 @@ class SurzhErrorifier(object):
         with open(out_folder + "/target.txt", 'w') as f:
             f.write(text)
 
-        print("Done!")
\ No newline at end of file
+        print("Done!")
+
+    def main_stream(self, input_file, out_folder, per_phrase=20):
+        """
+        Two lazy passes over the corpus: the first one finds the relevant sentence ids,
+        the second one keeps only the selected sentences in memory.
+        """
+        # extract ukr key phrases which to look for
+        ukr_key_phrases = [word[1][:-1] for word in self.surzhik_generator.surzhiks2]
+
+        # first pass: ids of relevant sentences, at most per_phrase of them for each key phrase
+        relevant_id = self.find_relevant_ids(self.stream_handler.read_lines(input_file), ukr_key_phrases, per_phrase)
+
+        idxs_to_surzhify = []
+        for key_phrase in ukr_key_phrases:
+            print(key_phrase + ': ' + str(len(relevant_id[key_phrase])))
+            idxs_to_surzhify += relevant_id[key_phrase]
+
+        # second pass: collecting the selected sentences only
+        wanted = set(idxs_to_surzhify)
+        selected = {sent_id: line for sent_id, line in enumerate(self.stream_handler.read_lines(input_file)) if sent_id in wanted}
+
+        s = time.time()
+        with open(out_folder + "/source.txt", 'w') as source, open(out_folder + "/target.txt", 'w') as target:
+            for i, sent_id in enumerate(idxs_to_surzhify):
+                prefix = '\n' if i else ''
+                source.write(prefix + self.surzhify(selected[sent_id]))
+                target.write(prefix + selected[sent_id])
+        print(time.time() - s)
+
+        print("Done!")
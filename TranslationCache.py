@@ -0,0 +1,40 @@
+import sqlite3
+
+class TranslationCache(object):
+    """
+    Persistent word translation cache, keyed by the model name and the word.
+    Lives in a SQLite file, so later runs over other corpora reuse earlier translations.
+    """
+    def __init__(self, path, model_name):
+        self.path = path
+        self.model_name = model_name
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS translations ("
+                                "model TEXT NOT NULL, word TEXT NOT NULL, translation TEXT NOT NULL, "
+                                "PRIMARY KEY (model, word)) WITHOUT ROWID")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, words, batch_size=500):
+        """ Returns {word: translation} for the words that are already cached """
+        words = list(words)
+        found = {}
+        # querying in batches to stay under the SQLite variable limit
+        for start in range(0, len(words), batch_size):
+            batch = words[start:start + batch_size]
+            query = ("SELECT word, translation FROM translations WHERE model = ? AND word IN (%s)"
+                     % ", ".join("?" * len(batch)))
+            found.update(self.connection.execute(query, [self.model_name] + batch))
+        self.hits += len(found)
+        self.misses += len(words) - len(found)
+        return found
+
+    def put_many(self, translations):
+        """ Stores the {word: translation} pairs """
+        self.connection.executemany("INSERT OR REPLACE INTO translations (model, word, translation) VALUES (?, ?, ?)",
+                                    ((self.model_name, word, translation) for word, translation in translations.items()))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
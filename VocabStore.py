@@ -0,0 +1,178 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+
+class VocabStore(object):
+    """
+    Compiled vocabulary: the union of the wordlist and the frequency vocabulary as a sorted string table.
+    The words are kept as one UTF-8 blob with offsets, next to a frequency array and membership flags.
+    All arrays are memory-mapped, so opening a store is instant and processes share one physical copy.
+
+    Lookups are binary searches over the byte-sorted table. All words with a given prefix form a contiguous
+    range of it, which is what the nodes of the prefix walk (root/child/frequency/word) are.
+
+    The sizes and modification times of the text dictionaries are kept in sources.json, and open() recompiles
+    the store when they change. A store is compiled next to its folder and moved into place whole, so processes
+    opening it at the same time never see half-written arrays.
+    """
+    IN_FREQUENCY = 1 # the word is in frequency-vocab.txt
+    IN_WORDLIST = 2 # the word is in wordlist.txt
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.strings = np.load(folder + "/strings.npy", mmap_mode='r')
+        self.offsets = np.load(folder + "/offsets.npy", mmap_mode='r')
+        self.frequencies = np.load(folder + "/frequencies.npy", mmap_mode='r')
+        self.flags = np.load(folder + "/flags.npy", mmap_mode='r')
+        self.size = len(self.frequencies)
+
+    @staticmethod
+    def sources(wordlist_file, frequency_file):
+        """ The size and the modification time of every text dictionary, None for a missing one """
+        signature = {}
+        for name, path in (("wordlist", wordlist_file), ("frequency", frequency_file)):
+            try:
+                stat = os.stat(path)
+                signature[name] = [stat.st_size, stat.st_mtime_ns]
+            except OSError:
+                signature[name] = None
+        return signature
+
+    @staticmethod
+    def build(wordlist_file, frequency_file, folder):
+        """ Compiles the text dictionaries into a store in folder, replacing the store there """
+        sources = VocabStore.sources(wordlist_file, frequency_file)
+        frequence_dict = {}
+        with open(frequency_file, 'r') as f:
+            for line in f:
+                if line.strip():
+                    k, v = line.strip().split()
+                    frequence_dict[k.strip()] = int(v.strip())
+        words = set()
+        with open(wordlist_file, 'r') as f:
+            for line in f:
+                word = line.replace("\n", "")
+                if word:
+                    words.add(word)
+
+        entries = sorted((word.encode('utf-8'), word) for word in words | set(frequence_dict))
+        offsets = np.zeros(len(entries) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(encoded) for encoded, word in entries])
+        frequencies = np.array([frequence_dict.get(word, 0) for encoded, word in entries], dtype=np.int64)
+        flags = np.array([(VocabStore.IN_FREQUENCY if word in frequence_dict else 0) | (VocabStore.IN_WORDLIST if word in words else 0)
+                          for encoded, word in entries], dtype=np.uint8)
+
+        # writing into a folder of its own on the same file system, then moving it into place
+        parent = os.path.dirname(os.path.abspath(folder))
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=os.path.basename(folder) + ".tmp", dir=parent)
+        os.chmod(tmp, 0o755) # like a folder made by makedirs, not a private temporary one
+        np.save(tmp + "/strings.npy", np.frombuffer(b''.join(encoded for encoded, word in entries), dtype=np.uint8))
+        np.save(tmp + "/offsets.npy", offsets)
+        np.save(tmp + "/frequencies.npy", frequencies)
+        np.save(tmp + "/flags.npy", flags)
+        with open(tmp + "/sources.json", 'w') as f:
+            json.dump(sources, f)
+        VocabStore.install(tmp, folder)
+
+    @staticmethod
+    def install(tmp, folder):
+        # the old store is moved aside first, a directory cannot replace a non-empty one;
+        # the processes that mapped it keep reading their copy
+        old = f"{folder}.old{os.getpid()}"
+        try:
+            os.replace(folder, old)
+        except FileNotFoundError:
+            old = None
+        try:
+            os.replace(tmp, folder)
+        except OSError:
+            # another process moved its store into place meanwhile, compiled from the same dictionaries
+            shutil.rmtree(tmp, ignore_errors=True)
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+
+    @staticmethod
+    def stale(folder, wordlist_file, frequency_file):
+        """ Whether the store in folder is missing, or was compiled from other versions of the text dictionaries """
+        if not os.path.exists(folder + "/flags.npy"):
+            return True
+        sources = VocabStore.sources(wordlist_file, frequency_file)
+        if None in sources.values():
+            return False # the dictionaries are not around, the store is all there is
+        try:
+            with open(folder + "/sources.json", 'r') as f:
+                return json.load(f) != sources
+        except (OSError, ValueError):
+            return True
+
+    @staticmethod
+    def open(folder, wordlist_file, frequency_file):
+        """ Memory-maps the store, compiling it from the text dictionaries on the first use and when they change """
+        if VocabStore.stale(folder, wordlist_file, frequency_file):
+            VocabStore.build(wordlist_file, frequency_file, folder)
+        return VocabStore(folder)
+
+    def entry(self, i):
+        return self.strings[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def bound(self, key, lo, hi, upper=False):
+        # first index in [lo, hi) whose entry cut to len(key) is >= key (or > key if upper)
+        n = len(key)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            head = self.entry(mid)[:n]
+            if head < key or (upper and head == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, word):
+        """ Index of the word in the table, or -1 """
+        key = word.encode('utf-8')
+        i = self.bound(key, 0, self.size)
+        if i < self.size and self.entry(i) == key:
+            return i
+        return -1
+
+    def __contains__(self, word):
+        # the frequency vocabulary, like the old vocab set
+        i = self.find(word)
+        return i != -1 and bool(self.flags[i] & self.IN_FREQUENCY)
+
+    def in_wordlist(self, word):
+        i = self.find(word)
+        return i != -1 and bool(self.flags[i] & self.IN_WORDLIST)
+
+    def frequency_of(self, word):
+        i = self.find(word)
+        if i == -1 or not self.flags[i] & self.IN_FREQUENCY:
+            return None
+        return int(self.frequencies[i])
+
+    # prefix walk: a node is (lo, hi, prefix) -- the range of the words starting with prefix
+    def root(self):
+        return (0, self.size, '')
+
+    def child(self, node, c):
+        lo, hi, prefix = node
+        prefix += c
+        key = prefix.encode('utf-8')
+        lo = self.bound(key, lo, hi)
+        hi = self.bound(key, lo, hi, upper=True)
+        if lo == hi:
+            return None
+        return (lo, hi, prefix)
+
+    def frequency(self, node):
+        # the prefix itself sorts first in its range
+        lo, hi, prefix = node
+        if self.flags[lo] & self.IN_FREQUENCY and self.entry(lo) == prefix.encode('utf-8'):
+            return int(self.frequencies[lo])
+        return None
+
+    def word(self, node):
+        return node[2]